@@ -27,15 +27,16 @@ def main():
     name_map = {}
     paths = list(pathlib.Path('csvs/polk').glob('*.csv'))
 
-    for csv_file in paths:
-        name_map[csv_file] = set()
-        with codecs.open(csv_file, encoding='utf-8', errors='ignore') as f:
+    # one connection for every lookup rather than one per row
+    with Postgres(**postgres_args) as cursor:
+        for csv_file in paths:
             name_map[csv_file] = set()
-            for row in csv.DictReader(f):
-                clean = clean_row(row)
-                name_map[csv_file].add((clean['First'], clean['Last']))
+            with codecs.open(csv_file, encoding='utf-8', errors='ignore') as f:
+                name_map[csv_file] = set()
+                for row in csv.DictReader(f):
+                    clean = clean_row(row)
+                    name_map[csv_file].add((clean['First'], clean['Last']))
 
-                with Postgres(**postgres_args) as cursor:
                     if find_by_name_and_address(cursor, clean):
                         print((clean['First'], clean['Last']), 'found...')
 
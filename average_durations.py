@@ -1,6 +1,6 @@
 import os
 from dotenv import load_dotenv
-from services import Postgres
+from services import Postgres, stream_rows
 from common import yes_no
 from constants import county_names
 
@@ -36,17 +36,16 @@ def build_county_dict(results=False):
     return counties
 
 
-def average_time_to_return(cursor):
+def average_time_to_return():
     query = (
-        'SELECT * '
+        'SELECT county, sent_date, receive_date '
         'FROM voters '
         'WHERE sent_date IS NOT NULL '
         'AND receive_date IS NOT NULL '
         'AND absentee_issue_method = \'Mailing\''
     )
-    cursor.execute(query)
     i = 1
-    for row in cursor.fetchall():
+    for row in stream_rows(postgres_args, query):
         print(f'Processing average time to return {i}...', end='\r')
         i += 1
         d = dict(row)
@@ -62,17 +61,16 @@ def average_time_to_return(cursor):
     print()
 
 
-def average_time_to_reject(cursor):
+def average_time_to_reject():
     query = (
-        'SELECT * '
+        'SELECT county, reject_date, receive_date '
         'FROM voters '
         'WHERE reject_date IS NOT NULL '
         'AND receive_date IS NOT NULL '
         'AND absentee_issue_method = \'Mailing\''
     )
-    cursor.execute(query)
     i = 1
-    for row in cursor.fetchall():
+    for row in stream_rows(postgres_args, query):
         print(f'Processing average time to reject {i}...', end='\r')
         i += 1
         d = dict(row)
@@ -90,17 +88,16 @@ def average_time_to_reject(cursor):
     print()
 
 
-def average_time_to_cure(cursor):
+def average_time_to_cure():
     query = (
-        'SELECT * '
+        'SELECT county, reject_date, cure_date '
         'FROM voters '
         'WHERE reject_date IS NOT NULL '
         'AND cure_date IS NOT NULL '
         'AND absentee_issue_method = \'Mailing\''
     )
-    cursor.execute(query)
     i = 1
-    for row in cursor.fetchall():
+    for row in stream_rows(postgres_args, query):
         print(f'Processing average time to cure {i}...', end='\r')
         i += 1
         d = dict(row)
@@ -134,9 +131,11 @@ def insert_averages(cursor):
 def main():
     with Postgres(**postgres_args) as cursor:
         cursor.execute('DELETE FROM average_durations')
-        average_time_to_return(cursor)
-        average_time_to_reject(cursor)
-        average_time_to_cure(cursor)
+    # each scan streams its rows rather than fetching the whole result set
+    average_time_to_return()
+    average_time_to_reject()
+    average_time_to_cure()
+    with Postgres(**postgres_args) as cursor:
         insert_averages(cursor)
 
 
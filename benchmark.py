@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+from dotenv import load_dotenv
+from services import Postgres
+from common import yes_no
+from migrate import migrate
+
+"""
+End-to-end ingest benchmark against the dev Postgres and the Redis on localhost from docker-compose.yaml
+(`docker-compose up -d postgres redis`). ingest_sos_chunk.py needs Redis for its kill_ingest check
+and its resume offsets, without it every chunk fails.
+
+Reinitializes the dev database, then for every day generated by generate_data.py runs process_sos_csv.py,
+ingest_sos_chunk.py for each chunk and ingest_county.py for each county, and finally average_durations.py.
+Each step is run as its own process (in the same way they are run during the election) and reports
+wall time, rows per second, statements sent to Postgres and the peak memory of the process.
+
+e.g.
+    python3 generate_data.py -v 100000 -n 3
+    python3 benchmark.py -o bench/results.json
+    python3 benchmark.py -c bench/results.json  # exits non-zero if a step got more than -t percent slower
+"""
+
+repo_dir = pathlib.Path(__file__).resolve().parent
+counties = ['Polk', 'Cerro Gordo', 'Des Moines']
+
+
+def count_rows(path):
+    # data rows only, the header does not count
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def statements(cursor):
+    # pg_stat_statements is loaded by docker-compose.yaml, None if this Postgres does not have it
+    if not has_pg_stat_statements:
+        return None
+    query = (
+        'SELECT COALESCE(SUM(calls), 0) '
+        'FROM pg_stat_statements '
+        'WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) '
+        'AND query NOT LIKE \'%%pg_stat_statements%%\' '
+        # the connection pool's health checks, pg_stat_statements normalizes the constant
+        'AND query NOT IN (\'SELECT 1\', \'SELECT $1\')'
+    )
+    cursor.execute(query)
+    return int(cursor.fetchone()[0])
+
+
+def reset_statements(cursor):
+    if has_pg_stat_statements:
+        cursor.execute('SELECT pg_stat_statements_reset()')
+
+
+def run(step, script, script_args, rows, stdin=None):
+    """
+    Run a script from the repo with the benchmark directory as its working directory.
+    stdin answers any prompts (e.g. 'n' for Target production?).
+    """
+    with Postgres(**postgres_args) as cursor:
+        reset_statements(cursor)
+
+    print(f'{step}...')
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, str(repo_dir / script)] + script_args,
+            cwd=args.root,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+            text=True
+        )
+        if stdin:
+            process.stdin.write(stdin)
+        process.stdin.close()
+        # wait4 rather than wait so that peak memory is this process's alone
+        _, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        returncode = os.waitstatus_to_exitcode(status)
+        # lets Popen see that the child is gone, so it does not try to reap it again (its returncode is not the real one)
+        process.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            sys.exit(f'{step} failed with exit code {returncode}:\n{stderr.read()}')
+
+    with Postgres(**postgres_args) as cursor:
+        number_of_statements = statements(cursor)
+
+    return {
+        'step': step,
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None,
+        'statements': number_of_statements,
+        # ru_maxrss is in KB on Linux
+        'peak_mb': rusage.ru_maxrss / 1024,
+    }
+
+
+def combine(step, results):
+    # e.g. one result for all of a day's chunks
+    seconds = sum([r['seconds'] for r in results])
+    rows = sum([r['rows'] for r in results])
+    statement_counts = [r['statements'] for r in results]
+    return {
+        'step': step,
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None,
+        'statements': None if None in statement_counts else sum(statement_counts),
+        'peak_mb': max([r['peak_mb'] for r in results]),
+    }
+
+
+def initialize():
+    global has_pg_stat_statements
+    with Postgres(**postgres_args) as cursor:
+        with open(repo_dir / 'schema.sql') as f:
+            cursor.execute(f.read())
+        # benchmark with the indexes production has
+        migrate(cursor)
+        try:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_stat_statements')
+            cursor.execute('SELECT pg_stat_statements_reset()')
+            has_pg_stat_statements = True
+        except Exception:
+            print('pg_stat_statements is not available, statements will not be counted')
+            has_pg_stat_statements = False
+
+
+def print_results(results, baseline):
+    header = f'{"step":<40}{"rows":>10}{"seconds":>10}{"rows/s":>10}{"stmts":>10}{"peak MB":>10}'
+    if baseline:
+        header += f'{"vs base":>10}'
+    print(header)
+    for r in results:
+        line = (
+            f'{r["step"]:<40}{r["rows"]:>10}{r["seconds"]:>10.2f}{r["rows_per_second"] or 0:>10.0f}'
+            f'{r["statements"] if r["statements"] is not None else "-":>10}{r["peak_mb"]:>10.1f}'
+        )
+        if baseline and r['step'] in baseline:
+            line += f'{change(baseline[r["step"]], r):>+9.1f}%'
+        print(line)
+
+
+def change(base, result):
+    # percent change in wall time, positive is slower
+    return (result['seconds'] - base['seconds']) / base['seconds'] * 100 if base['seconds'] else 0
+
+
+def main():
+    days = sorted([path.stem for path in pathlib.Path(f'{args.root}/csvs/sos').glob('??-??.csv')])
+    if not days:
+        sys.exit(f'No SoS CSVs in {args.root}/csvs/sos, run generate_data.py first')
+
+    if not args.yes and not yes_no(f'Drop and recreate every table in the dev database {postgres_args["dbname"]}?'):
+        return 0
+    initialize()
+
+    results = []
+    for day in days:
+        # chunks left over from an earlier run with a different -n would otherwise be ingested too
+        for path in pathlib.Path(f'{args.root}/csvs/sos').glob(f'{day}_*.csv'):
+            if path.stem.split('_')[1].isdigit():
+                path.unlink()
+
+        results.append(run(
+            f'process_sos_csv {day}', 'process_sos_csv.py', ['-d', day, '-n', str(args.number_of_chunks)],
+            count_rows(f'{args.root}/csvs/sos/{day}.csv')
+        ))
+
+        chunk_results = []
+        chunks = sorted(
+            [p for p in pathlib.Path(f'{args.root}/csvs/sos').glob(f'{day}_*.csv') if p.stem.split('_')[1].isdigit()],
+            key=lambda p: int(p.stem.split('_')[1])
+        )
+        for path in chunks:
+            chunk = path.stem.split('_')[1]
+            chunk_results.append(run(
+                f'ingest_sos_chunk {day} #{chunk}', 'ingest_sos_chunk.py', ['-d', day, '-c', chunk] + args.ingest_args,
+                count_rows(path)
+            ))
+        if chunk_results:
+            results.append(combine(f'ingest_sos_chunk {day} (all chunks)', chunk_results))
+
+        for county in counties:
+            path = pathlib.Path(f'{args.root}/csvs/{county.lower().replace(" ", "_")}/{day}.csv')
+            if path.exists():
+                results.append(run(
+                    f'ingest_county {day} {county}', 'ingest_county.py', ['-d', day, '-c', county],
+                    count_rows(path), stdin='n\n'
+                ))
+
+    with Postgres(**postgres_args) as cursor:
+        cursor.execute('SELECT COUNT(*) FROM voters')
+        number_of_voters = cursor.fetchone()[0]
+    results.append(run('average_durations', 'average_durations.py', [], number_of_voters, stdin='n\n'))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {r['step']: r for r in json.load(f)['results']}
+
+    print()
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'days': days, 'number_of_chunks': args.number_of_chunks, 'results': results}, f, indent=2)
+        print(f'Wrote {args.output}')
+
+    if baseline:
+        regressions = [r['step'] for r in results if r['step'] in baseline and change(baseline[r['step']], r) > args.threshold]
+        if regressions:
+            print(f'Slower than the baseline by more than {args.threshold}%: {", ".join(regressions)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # directory generate_data.py wrote to, scripts are run from here so logs and chunks stay out of the repo
+    parser.add_argument('-r', dest='root', default='bench')
+    parser.add_argument('-n', dest='number_of_chunks', type=int, default=10)
+    # extra arguments for every ingest_sos_chunk.py run, e.g. -a=-m to benchmark merge mode
+    parser.add_argument('-a', dest='ingest_args', action='append', default=[])
+    parser.add_argument('-o', dest='output')
+    # a results file from an earlier -o to compare against
+    parser.add_argument('-c', dest='compare')
+    parser.add_argument('-t', dest='threshold', type=float, default=20)
+    parser.add_argument('-y', dest='yes', action='store_true', default=False)
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    # only ever the dev database, initialize() drops every table
+    postgres_args = {
+        'host': os.getenv('DEV_POSTGRES_HOST'),
+        'port': int(os.getenv('DEV_POSTGRES_PORT')),
+        'user': os.getenv('DEV_POSTGRES_USER'),
+        'password': os.getenv('DEV_POSTGRES_PASSWORD'),
+        'dbname': os.getenv('DEV_POSTGRES_DB'),
+    }
+
+    has_pg_stat_statements = False
+
+    sys.exit(main())
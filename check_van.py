@@ -1,22 +1,22 @@
 import csv
 import argparse
 import os
+import sys
 import civis
-import subprocess
 from dotenv import load_dotenv
-from services import Postgres
+from services import Postgres, stream_rows
+from sos_archive import lookup, archived_days
 
 
 def currently_rejected_case_one():
+    # streamed, main only needs the registration numbers
     query = (
-        'SELECT * '
+        'SELECT registration_number '
         'FROM voters '
         'WHERE county IN (\'Polk\', \'Cerro Gordo\', \'Des Moines\') '
         'AND ballot_status IS NOT NULL'
     )
-    with Postgres(**postgres_args) as cursor:
-        cursor.execute(query)
-        return [dict(row) for row in cursor.fetchall()]
+    return stream_rows(postgres_args, query)
 
 
 def all_rejected_van():
@@ -98,7 +98,11 @@ def get_voters_set_as_cured_new_ballot(date):
         return [row for row in csv.DictReader(f)]
 
 
-def compare_rejected(date):
+def compare_rejected(date, sos_day):
+    # sos_day's archived SoS file supplies the rows of the voters missing from Postgres
+    if sos_day not in archived_days():
+        sys.exit(f'SoS {sos_day} is not archived, run python3 sos_archive.py -a {sos_day} first')
+
     query = (
         'select * from voters where reject_date = %s'
     )
@@ -126,17 +130,16 @@ def compare_rejected(date):
 
     # for vid in not_in_civis:
     #     if rejected_row_dict[vid]['county'] != 'Polk' and rejected_row_dict[vid]['party'] == 'DEM':
-    #         p = subprocess.run(['grep', f'{vid}', '/Users/dingo/dev/IACC_2020/cure/csvs/sos/10-31.csv'], capture_output=True)
-    #         print('\n', p.stdout, '\n')
+    #         print('\n', lookup(sos_day, vid), '\n')
 
+    # the voter's rows from the archived SoS file, a binary search not a grep
     for vid in not_in_psql:
-        p = subprocess.run(['grep', f'{vid}', '/Users/dingo/dev/IACC_2020/cure/csvs/sos/10-31.csv'], capture_output=True)
-        print('\n', p.stdout, '\n')
+        print('\n', lookup(sos_day, vid), '\n')
 
 
 def main():
     # get_voters_set_as_rejected(args.date)
-    # compare_rejected(args.date)
+    # compare_rejected(args.date, args.sos_day)
 
     psql_rows = currently_rejected_case_one()
     civis_rows = all_rejected_van()
@@ -158,6 +161,8 @@ def main():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', dest='date', required=True)
+    # the archived SoS day compare_rejected looks voters up in (python3 sos_archive.py -a <day>)
+    parser.add_argument('-a', dest='sos_day')
     args = parser.parse_args()
 
     load_dotenv()
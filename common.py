@@ -1,17 +1,71 @@
 import codecs
+import contextlib
+import itertools
 from distutils.util import strtobool
-from constants import primary_sql_keys
+from constants import primary_sql_keys, sos_csv_headers
 
 """
 Common utility methods.
 """
 
 
-def replace_bom(path):
+@contextlib.contextmanager
+def open_csv(path):
+    """
+    Open a CSV for csv.DictReader, dropping the BOM present in many Excel documents and CSVs exported from Excel
+    (and any stray ones left by concatenating exports) line by line as it is read.
+    The file is never loaded whole or rewritten.
+    """
     with codecs.open(path, encoding='utf-8', errors='ignore') as f:
-        clean = f.read().replace('\ufeff', '')
-    with open(path, 'w') as f:
-        f.write(clean)
+        yield (line.replace('\ufeff', '') for line in f)
+
+
+def sos_voter_id(row):
+    """
+    The voter ID of a raw SoS row as an int, or None for the rows that are not ingested:
+    no voter ID, a missing name or address, or a non-int voter ID.
+    """
+    if not row.get('VOTER_ID'):
+        return None
+    # skip any row that does not provide a value for these fields
+    if not all([row.get(pk) for pk in ['FIRST_NAME', 'LAST_NAME', 'RESIDENTIAL_ADDRESS_LINE_1']]):
+        return None
+    try:
+        return int(row.get('VOTER_ID'))
+    except ValueError:
+        # skip any row that has a non-int for VOTER_ID
+        return None
+
+
+def clean_sos_row(row):
+    clean = {}
+    for k, v in row.items():
+        if not k or k.strip() not in sos_csv_headers:
+            continue
+        # strip leading and trailing whitespace from all keys and values
+        # reducing all inter-string whitespace to a single ' '
+        clean[k.strip()] = ' '.join(v.strip().split()) if type(v) is str else v
+    return clean
+
+
+def read_voter_groups(reader, key='VOTER_ID'):
+    """
+    Yield (voter ID, rows) for each run of consecutive rows sharing a voter ID.
+    Only one voter's rows are held at a time, so every voter's rows must be contiguous
+    (process_sos_csv.py writes its chunks this way, regrouping any voter the SoS file interleaves).
+    Nothing is kept across voters to check this, memory stays flat however long the chunk is.
+    """
+    for voter_id, rows in itertools.groupby(reader, key=lambda row: row[key]):
+        yield voter_id, list(rows)
+
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
 
 
 def yes_no(question, default='no'):
@@ -46,11 +100,27 @@ def get_voter(cursor, voter_id):
         'FROM voters '
         'WHERE registration_number = %s'
     )
-    cursor.execute(query, (voter_id,))
+    cursor.execute_prepared('get_voter', query, (voter_id,))
     result = cursor.fetchone()
     return dict(result) if result else None
 
 
+def get_voters(cursor, voter_ids, batch_size=5000):
+    # fetch many voters in a handful of round trips, keyed by registration number
+    voter_ids = list(voter_ids)
+    query = (
+        'SELECT * '
+        'FROM voters '
+        'WHERE registration_number = ANY(%s)'
+    )
+    voters = {}
+    for i in range(0, len(voter_ids), batch_size):
+        cursor.execute_prepared('get_voters', query, (voter_ids[i:i + batch_size],))
+        for result in cursor.fetchall():
+            voters[result['registration_number']] = dict(result)
+    return voters
+
+
 def find_by_name_and_address(cursor, row):
     query = (
         'SELECT * '
@@ -61,20 +131,24 @@ def find_by_name_and_address(cursor, row):
     )
 
     query_args = (row['last_name'], row['first_name'], row['resident_address'])
+    # one prepared statement per combination of NULL and non-NULL middle name and suffix
+    name = 'find_by_name_and_address'
 
     if row['middle_name']:
         query += ' AND middle_name = %s'
         query_args += (row['middle_name'],)
+        name += '_middle'
     else:
         query += ' AND middle_name IS NULL'
 
     if row['name_suffix']:
         query += ' AND name_suffix = %s'
         query_args += (row['name_suffix'],)
+        name += '_suffix'
     else:
         query += ' AND name_suffix IS NULL'
 
-    cursor.execute(query, query_args)
+    cursor.execute_prepared(name, query, query_args)
     existing_row = cursor.fetchone()
     return dict(existing_row) if existing_row else None
 
@@ -85,7 +159,7 @@ def find_by_registration_number(cursor, registration_number):
         'FROM voters '
         'WHERE registration_number = %s'
     )
-    cursor.execute(query, (registration_number,))
+    cursor.execute_prepared('get_voter', query, (registration_number,))
     existing_row = cursor.fetchone()
     return dict(existing_row) if existing_row else None
 
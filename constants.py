@@ -218,6 +218,50 @@ sos_csv_headers = {
     'SPLIT': 'split',
 }
 
+# every column of the voters table that ingest writes (id, created_at and updated_at are managed by the DB)
+voters_keys = [
+    'logs',
+    'log',
+    'county_data',
+    'number_of_rows',
+    'has_voided_ballot',
+    'was_removed',
+    'reject_date',
+    'cure_date',
+    'number_of_rejections',
+    'was_ever_rejected',
+    'currently_rejected',
+    'reject_reason',
+    'sos_digest',
+    'last_name',
+    'first_name',
+    'middle_name',
+    'name_suffix',
+    'county',
+    'registration_number',
+    'date_of_birth',
+    'resident_address',
+    'mailing_address',
+    'absentee_address',
+    'phone_number',
+    'city',
+    'state',
+    'zip',
+    'voter_status',
+    'party',
+    'precinct',
+    'ballot_status',
+    'request_date',
+    'sent_date',
+    'receive_date',
+    'is_void',
+    'comments',
+    'absentee_sequence_number',
+    'absentee_issue_method',
+    'absentee_receive_method',
+    'split'
+]
+
 voter_demographics_keys = [
     'registration_number',
     'party',
@@ -11,7 +11,7 @@ from multiprocessing import Pool
 from services import Postgres
 from psycopg2.extensions import AsIs
 from constants import county_csv_headers, date_keys
-from common import replace_bom, yes_no, pk_string, find_by_name_and_address, find_by_registration_number
+from common import open_csv, yes_no, pk_string, find_by_name_and_address, find_by_registration_number
 
 """
 This script is idempotent when run on a directory corresponding to a given day.
@@ -176,12 +176,9 @@ def ingest_csv(args_tuple):
     log_dir = 'logs' if is_prod else 'dev_logs'
     logging.basicConfig(filename=f'{log_dir}/{path.stem}-{day}.log', format='%(asctime)s | %(message)s', level=logging.INFO)
 
-    # remove the leading BOM present in many Excel documents and CSVs exported from Excel
-    replace_bom(path)
-
     with Postgres(**postgres_args_) as cursor:
         print(f'Processing {path.name}...')
-        with open(path) as f:
+        with open_csv(path) as f:
             for row in csv.DictReader(f):
                 try:
                     insert_row(cursor, clean_row(row), path.stem, day)
@@ -0,0 +1,178 @@
+import csv
+import argparse
+import json
+import tempfile
+import zlib
+from constants import sos_csv_headers
+from common import open_csv, sos_voter_id, clean_sos_row
+from sos_engine import construct_psql_rows, active_void
+
+"""
+Compares two daily SoS CSVs, e.g. `python3 diff_sos.py -a 10-30 -b 10-31`, and writes:
+
+- csvs/sos/10-31_delta.csv: the rows of every voter that was added or changed, grouped by voter like a chunk
+- csvs/sos/10-31_diff.json: counts of added / removed / changed voters and which fields changed on the
+  voters' active rows (as active_void picks them)
+- csvs/sos/10-31_diff_ids.csv: the added, removed and changed voter IDs, one per line with the change
+
+Both files are hash partitioned by voter ID into temporary files first and compared one partition at a time,
+so memory is bounded by a single partition of each file rather than both whole files.
+Voter IDs and rows are written out partition by partition, only the counts are kept.
+process_sos_csv.py -b uses the same comparison to only chunk the voters that changed.
+"""
+
+headers = list(sos_csv_headers.keys())
+
+
+def partition(day, directory, number_of_partitions):
+    """
+    Split a day's file into number_of_partitions files by voter ID, cleaned and filtered as process_sos_csv.py does.
+    """
+    paths = [f'{directory}/{day}_{i}.csv' for i in range(number_of_partitions)]
+    files = [open(path, 'w', newline='') for path in paths]
+    try:
+        writers = [csv.writer(f) for f in files]
+        with open_csv(f'csvs/sos/{day}.csv') as f:
+            for row in csv.DictReader(f):
+                voter_id = sos_voter_id(row)
+                if voter_id is None:
+                    continue
+                clean = clean_sos_row(row)
+                writers[zlib.crc32(str(voter_id).encode()) % number_of_partitions].writerow(
+                    [voter_id] + [clean.get(header) or '' for header in headers])
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def load_partition(path):
+    # voter ID => rows in file order, each row a list of values in header order
+    voters = {}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            voters.setdefault(int(row[0]), []).append(row[1:])
+    return voters
+
+
+def active_row(rows):
+    # the row ingest stores for this voter, and the voter's number of void rows
+    psql_rows = construct_psql_rows([dict(zip(headers, row)) for row in rows])
+    active, _, _, void_count = active_void(psql_rows)
+    return active, void_count
+
+
+def compare(old_rows, new_rows, summary):
+    """
+    Tally what changed between a voter's old and new row groups.
+    """
+    if len(old_rows) != len(new_rows):
+        summary['row_count_changed'] += 1
+
+    try:
+        old_active, old_void_count = active_row(old_rows)
+        new_active, new_void_count = active_row(new_rows)
+    except (KeyError, ValueError):
+        # e.g. an unknown county code, ingest will log the error for this voter
+        summary['unparseable'] += 1
+        return
+    if old_void_count != new_void_count:
+        summary['void_count_changed'] += 1
+    for field in new_active.keys():
+        if old_active.get(field) != new_active.get(field):
+            summary['fields'][field] = summary['fields'].get(field, 0) + 1
+
+
+def diff(old_day, new_day, number_of_partitions=16, delta_path=None, ids_path=None):
+    """
+    Compare old_day's SoS file to new_day's and return the summary counts.
+    If delta_path is given the new rows of the added and changed voters are written there,
+    if ids_path is given every added, removed and changed voter ID is written there as voter_id,change.
+    """
+    summary = {
+        'old_day': old_day,
+        'new_day': new_day,
+        'added': 0,
+        'removed': 0,
+        'changed': 0,
+        'unchanged': 0,
+        'row_count_changed': 0,
+        'void_count_changed': 0,
+        'unparseable': 0,
+        'fields': {},
+    }
+
+    delta_file = open(delta_path, 'w', newline='') if delta_path else None
+    ids_file = open(ids_path, 'w', newline='') if ids_path else None
+    try:
+        if delta_file:
+            delta_writer = csv.writer(delta_file)
+            delta_writer.writerow(headers)
+        if ids_file:
+            ids_writer = csv.writer(ids_file)
+            ids_writer.writerow(['voter_id', 'change'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            print(f'Partitioning {old_day}.csv...')
+            old_paths = partition(old_day, directory, number_of_partitions)
+            print(f'Partitioning {new_day}.csv...')
+            new_paths = partition(new_day, directory, number_of_partitions)
+
+            for i, (old_path, new_path) in enumerate(zip(old_paths, new_paths)):
+                print(f'Comparing partition {i + 1} of {number_of_partitions}...', end='\r')
+                old_voters = load_partition(old_path)
+                new_voters = load_partition(new_path)
+
+                for voter_id, new_rows in new_voters.items():
+                    old_rows = old_voters.pop(voter_id, None)
+                    if old_rows is None:
+                        summary['added'] += 1
+                        change = 'added'
+                    elif old_rows == new_rows:
+                        summary['unchanged'] += 1
+                        continue
+                    else:
+                        summary['changed'] += 1
+                        change = 'changed'
+                        compare(old_rows, new_rows, summary)
+                    if ids_file:
+                        ids_writer.writerow([voter_id, change])
+                    if delta_file:
+                        delta_writer.writerows(new_rows)
+
+                # whatever is left of the old partition is not in the new file
+                summary['removed'] += len(old_voters)
+                if ids_file:
+                    ids_writer.writerows([[voter_id, 'removed'] for voter_id in old_voters])
+            print()
+    finally:
+        if delta_file:
+            delta_file.close()
+        if ids_file:
+            ids_file.close()
+
+    return summary
+
+
+def main():
+    stem = f'csvs/sos/{args.new_day}'
+    summary = diff(args.old_day, args.new_day, args.number_of_partitions, f'{stem}_delta.csv', f'{stem}_diff_ids.csv')
+    with open(f'{stem}_diff.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f'{args.old_day} => {args.new_day}')
+    print(f'  added: {summary["added"]}, removed: {summary["removed"]}, changed: {summary["changed"]}, unchanged: {summary["unchanged"]}')
+    print(f'  changed number of rows: {summary["row_count_changed"]}, changed number of voided ballots: {summary["void_count_changed"]}')
+    for field, count in sorted(summary['fields'].items(), key=lambda x: x[1], reverse=True):
+        print(f'  {field}: {count}')
+    print(f'Wrote {stem}_delta.csv, {stem}_diff.json and {stem}_diff_ids.csv')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', dest='old_day', required=True)
+    parser.add_argument('-b', dest='new_day', required=True)
+    # more partitions, less memory
+    parser.add_argument('-k', dest='number_of_partitions', type=int, default=16)
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+from constants import code_county_map
+from digest_sos import pks, parties, pct
+
+"""
+Columnar engine for digest_sos.py.
+
+Loads only the columns the digest needs, encodes them as typed NumPy arrays (county index, party code, flags)
+from categorical columns, so per-row values are worked out once per distinct value
+and computes every grouped count with a single bincount instead of updating counters row by row.
+aggregate returns the same report shape as digest_sos.summarize, so both can be printed or written as JSON / CSV.
+
+To add a cut: encode the column in load_columns and bincount it against the masks in aggregate.
+"""
+
+# the election-week Tuesday the request date breakdown looks at
+tuesday_request_date = '10/27/2020'
+
+columns = [
+    'COUNTY_CODE',
+    'POLITICAL_PARTY',
+    'RECEIVED_DATE',
+    'BALLOT_STATUS',
+    'REQUEST_DATE',
+    'DATE_OF_BIRTH',
+    'ABSENTEE_ISSUE_METHOD',
+    'VOTER_ID',
+] + pks
+
+# county codes run 1 - 99, index 0 collects anything unparseable
+number_of_codes = 100
+
+
+def mapped(column, function, dtype, default):
+    # function is applied once per distinct value of a categorical column and broadcast to every row by its code
+    values = np.array([function(value) for value in column.cat.categories] + [default], dtype=dtype)
+    # code -1 (a missing value) indexes the default at the end
+    return values[column.cat.codes.to_numpy()]
+
+
+def county_index(value):
+    return int(value) if value.strip().isdigit() and int(value) < number_of_codes else 0
+
+
+def birth_year(value):
+    # MM/DD/YYYY, padded or not, 0 when there is no year
+    year = value.split('/')[2] if value.count('/') == 2 else ''
+    return int(year) if year.isdigit() else 0
+
+
+def load_columns(path):
+    # pandas decodes the file itself, utf-8-sig drops a leading BOM and shockingly these files are not well-encoded
+    # every column but the names is categorical, parsed to integer codes plus its distinct values
+    dtypes = {column: 'category' for column in columns}
+    dtypes.update({pk: str for pk in pks})
+    df = pd.read_csv(
+        path, usecols=columns, dtype=dtypes, keep_default_na=False, encoding='utf-8-sig', encoding_errors='ignore')
+
+    valid = np.ones(len(df), dtype=bool)
+    for pk in pks:
+        valid &= df[pk].to_numpy() != ''
+
+    return {
+        'valid': valid,
+        'county': mapped(df['COUNTY_CODE'], county_index, np.int16, 0),
+        # index into parties: dems, reps, oths
+        'party': mapped(df['POLITICAL_PARTY'], lambda v: {'Democrat': 0, 'Republican': 1}.get(v, 2), np.int8, 2),
+        'received': mapped(df['RECEIVED_DATE'], lambda v: v != '', bool, False),
+        'rejected': mapped(df['BALLOT_STATUS'], lambda v: 'Affidavit' in v, bool, False),
+        'tuesday': mapped(df['REQUEST_DATE'], lambda v: v == tuesday_request_date, bool, False),
+        'voter_id': df['VOTER_ID'].cat.codes.to_numpy(),
+        'birth_year': mapped(df['DATE_OF_BIRTH'], birth_year, np.int16, 0),
+        'political_party': df['POLITICAL_PARTY'],
+        'issue_method': df['ABSENTEE_ISSUE_METHOD'],
+    }
+
+
+def grouped_counts(county, party, mask):
+    # counts by (county code, party) in one pass
+    return np.bincount(
+        county[mask].astype(np.int64) * len(parties) + party[mask],
+        minlength=number_of_codes * len(parties)
+    ).reshape(number_of_codes, len(parties))
+
+
+def value_counts(values):
+    unique, counts = np.unique(values, return_counts=True)
+    return {str(k): int(v) for k, v in zip(unique, counts)}
+
+
+def category_counts(column, indices):
+    # counts of a categorical column's values at indices, from its codes
+    codes = column.cat.codes.to_numpy()[indices]
+    counts = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories))
+    return {str(value): int(count) for value, count in zip(column.cat.categories, counts) if count}
+
+
+def aggregate(path):
+    c = load_columns(path)
+    valid = c['valid']
+    received = valid & c['received']
+    rejected = received & c['rejected']
+
+    tracked_counts = grouped_counts(c['county'], c['party'], valid)
+    received_counts = grouped_counts(c['county'], c['party'], received)
+    rejected_counts = grouped_counts(c['county'], c['party'], rejected)
+
+    def counts(code_index):
+        if code_index is None:
+            tracked, rec, rej = tracked_counts.sum(axis=0), received_counts.sum(axis=0), rejected_counts.sum(axis=0)
+        else:
+            tracked, rec, rej = tracked_counts[code_index], received_counts[code_index], rejected_counts[code_index]
+        v = {}
+        for i, key in enumerate(parties):
+            v[key] = int(tracked[i])
+            v[f'{key}_rec'] = int(rec[i])
+            v[f'{key}_rej'] = int(rej[i])
+            v[f'{key}_rtn_pct'] = pct(v[f'{key}_rec'], v[key])
+            v[f'{key}_rej_pct'] = pct(v[f'{key}_rej'], v[f'{key}_rec'])
+        return v
+
+    totals = counts(None)
+    totals['missing_pk'] = int((~valid).sum())
+
+    by_county = {}
+    for code, county in code_county_map.items():
+        by_county[code] = {'name': county['name'], 'code': code, **counts(int(code))}
+
+    counties_reporting = [code for code in code_county_map.keys() if rejected_counts[int(code)].sum() > 0]
+
+    # the row-by-row digest keys these by voter so the last row of a voter wins, keep the last occurrence of each
+    tuesday = np.flatnonzero(valid & c['tuesday'])
+    reversed_ids = c['voter_id'][tuesday][::-1]
+    _, first_of_reversed = np.unique(reversed_ids, return_index=True)
+    tuesday = tuesday[::-1][first_of_reversed]
+
+    return {
+        'totals': totals,
+        'by_county': by_county,
+        'counties_reporting': counties_reporting,
+        'yob_count': value_counts(c['birth_year'][tuesday]),
+        'party_count': category_counts(c['political_party'], tuesday),
+        'method_count': category_counts(c['issue_method'], tuesday),
+    }
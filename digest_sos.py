@@ -1,20 +1,29 @@
 import csv
 import argparse
-import codecs
+import json
+import os
+import pathlib
 from constants import code_county_map
+from common import open_csv
 
 
 """
 Simple script to analyze the daily SoS CSV.
+By default the counts are computed by the columnar engine in digest_engine.py, -s tallies one row at a time.
+process_sos_csv.py -g prints the same digest from its own pass over the file.
+Reports are cached in csvs/sos/digests, so -t trends over many days only parse new or changed files.
 """
 
+pks = ['FIRST_NAME', 'LAST_NAME', 'RESIDENTIAL_ADDRESS_LINE_1']
+parties = ['dems', 'reps', 'oths']
+# the names -k accepts, as they appear in by_county
+county_names = {county['name'] for county in code_county_map.values()}
 
-def main():
-    counties_reporting = set()
-    all_counties = {k for k, _ in code_county_map.items()}
+# one report per day, keyed by the SoS file's mtime and size
+cache_dir = 'csvs/sos/digests'
 
-    req_tues = {}
 
+def new_digest():
     totals = {
         'dems': 0,
         'reps': 0,
@@ -44,64 +53,100 @@ def main():
             'oths_rej': 0
         }
 
-    pks = ['FIRST_NAME', 'LAST_NAME', 'RESIDENTIAL_ADDRESS_LINE_1']
-
-    # shockingly these files are not well-encoded
-    with codecs.open(f'csvs/sos/{args.day}.csv', encoding='utf-8', errors='ignore') as f:
-        for row in csv.DictReader(f):
-            if not all([row[pk] for pk in pks]):
-                totals['missing_pk'] += 1
-                continue
-            county_code = row['COUNTY_CODE']
-
-            if len(county_code) == 1:
-                county_code = '0' + county_code
-
-            if row['POLITICAL_PARTY'] == 'Democrat':
-                key = 'dems'
-            elif row['POLITICAL_PARTY'] == 'Republican':
-                key = 'reps'
-            else:
-                key = 'oths'
-
-            if row['REQUEST_DATE'] == '10/27/2020':
-                req_tues[row['VOTER_ID']] = {
-                    'ABSENTEE_ISSUE_METHOD': row['ABSENTEE_ISSUE_METHOD'],
-                    'POLITICAL_PARTY': row['POLITICAL_PARTY'],
-                    'DATE_OF_BIRTH': row['DATE_OF_BIRTH']
-                }
-
-            totals[key] += 1
-            by_county[county_code][key] += 1
-            if row['RECEIVED_DATE']:
-                totals[f'{key}_rec'] += 1
-                by_county[county_code][f'{key}_rec'] += 1
-                if row['BALLOT_STATUS'] and 'Affidavit' in row['BALLOT_STATUS']:
-                    totals[f'{key}_rej'] += 1
-                    by_county[county_code][f'{key}_rej'] += 1
-                    counties_reporting.add(county_code)
-
-    # TODO: replace this console output with something more useful
+    return {
+        'totals': totals,
+        'by_county': by_county,
+        'counties_reporting': set(),
+        'req_tues': {},
+    }
+
+
+def tally_row(digest, row):
+    """
+    Add one raw row of the SoS CSV to digest, so that any pass over the file (e.g. process_sos_csv.py) can build it.
+    """
+    totals = digest['totals']
+    by_county = digest['by_county']
+
+    if not all([row[pk] for pk in pks]):
+        totals['missing_pk'] += 1
+        return
+    county_code = row['COUNTY_CODE']
+
+    if len(county_code) == 1:
+        county_code = '0' + county_code
+
+    if row['POLITICAL_PARTY'] == 'Democrat':
+        key = 'dems'
+    elif row['POLITICAL_PARTY'] == 'Republican':
+        key = 'reps'
+    else:
+        key = 'oths'
+
+    if row['REQUEST_DATE'] == '10/27/2020':
+        digest['req_tues'][row['VOTER_ID']] = {
+            'ABSENTEE_ISSUE_METHOD': row['ABSENTEE_ISSUE_METHOD'],
+            'POLITICAL_PARTY': row['POLITICAL_PARTY'],
+            'DATE_OF_BIRTH': row['DATE_OF_BIRTH']
+        }
+
+    totals[key] += 1
+    by_county[county_code][key] += 1
+    if row['RECEIVED_DATE']:
+        totals[f'{key}_rec'] += 1
+        by_county[county_code][f'{key}_rec'] += 1
+        if row['BALLOT_STATUS'] and 'Affidavit' in row['BALLOT_STATUS']:
+            totals[f'{key}_rej'] += 1
+            by_county[county_code][f'{key}_rej'] += 1
+            digest['counties_reporting'].add(county_code)
+
+
+def pct(part, whole):
+    return round(100 * part / whole, 2) if whole else None
+
+
+def summarize(digest):
+    """
+    Turn a digest built row by row with tally_row into a report (the same shape digest_engine.aggregate returns).
+    """
+    report = {
+        'totals': dict(digest['totals']),
+        'by_county': {k: dict(v) for k, v in digest['by_county'].items()},
+        'counties_reporting': sorted(digest['counties_reporting']),
+        'yob_count': {},
+        'party_count': {},
+        'method_count': {},
+    }
+
+    for v in [report['totals']] + list(report['by_county'].values()):
+        for key in parties:
+            v[f'{key}_rtn_pct'] = pct(v[f'{key}_rec'], v[key])
+            v[f'{key}_rej_pct'] = pct(v[f'{key}_rej'], v[f'{key}_rec'])
+
+    for v in digest['req_tues'].values():
+        yob = v['DATE_OF_BIRTH'].split('/')[2]
+        report['yob_count'][yob] = report['yob_count'].get(yob, 0) + 1
+        report['party_count'][v['POLITICAL_PARTY']] = report['party_count'].get(v['POLITICAL_PARTY'], 0) + 1
+        report['method_count'][v['ABSENTEE_ISSUE_METHOD']] = report['method_count'].get(v['ABSENTEE_ISSUE_METHOD'], 0) + 1
+
+    return report
+
+
+def print_report(report):
+    totals = report['totals']
+    by_county = report['by_county']
 
     print('TOTALS')
     print('  Democrats')
-    print('    ', totals['dems'], 'tracked;', totals['dems_rec'], 'received;', f'{round(100 * totals["dems_rec"] / totals["dems"], 2)}% return pct;', totals['dems_rej'], 'rejected;', f'{round(100 * totals["dems_rej"] / totals["dems_rec"], 2)}% rejection rate')
+    print('    ', totals['dems'], 'tracked;', totals['dems_rec'], 'received;', f'{totals["dems_rtn_pct"]}% return pct;', totals['dems_rej'], 'rejected;', f'{totals["dems_rej_pct"]}% rejection rate')
     print('  Republicans')
-    print('    ', totals['reps'], 'tracked;', totals['reps_rec'], 'received;', f'{round(100 * totals["reps_rec"] / totals["reps"], 2)}% return pct;', totals['reps_rej'], 'rejected;', f'{round(100 * totals["reps_rej"] / totals["reps_rec"], 2)}% rejection rate')
+    print('    ', totals['reps'], 'tracked;', totals['reps_rec'], 'received;', f'{totals["reps_rtn_pct"]}% return pct;', totals['reps_rej'], 'rejected;', f'{totals["reps_rej_pct"]}% rejection rate')
     print('  Others')
-    print('    ', totals['oths'], 'tracked;', totals['oths_rec'], 'received;', f'{round(100 * totals["oths_rec"] / totals["oths"], 2)}% return pct;', totals['oths_rej'], 'rejected;', f'{round(100 * totals["oths_rej"] / totals["oths_rec"], 2)}% rejection rate')
-
-    for v in by_county.values():
-        v['dems_rtn_pct'] = round(100 * v['dems_rec'] / v['dems'], 2)
-        v['reps_rtn_pct'] = round(100 * v['reps_rec'] / v['reps'], 2)
-        v['oths_rtn_pct'] = round(100 * v['oths_rec'] / v['oths'], 2)
-        v['dems_rej_pct'] = round(100 * v['dems_rej'] / v['dems_rec'], 2)
-        v['reps_rej_pct'] = round(100 * v['reps_rej'] / v['reps_rec'], 2)
-        v['oths_rej_pct'] = round(100 * v['oths_rej'] / v['oths_rec'], 2)
+    print('    ', totals['oths'], 'tracked;', totals['oths_rec'], 'received;', f'{totals["oths_rtn_pct"]}% return pct;', totals['oths_rej'], 'rejected;', f'{totals["oths_rej_pct"]}% rejection rate')
 
     print('\nTOP COUNTIES')
     highest_dem_rej_counties = sorted(by_county.values(), key=lambda x: x['dems_rej'], reverse=True)[:5]
-    highest_dem_rej_rate_counties = sorted(by_county.values(), key=lambda x: x['dems_rej_pct'], reverse=True)[:5]
+    highest_dem_rej_rate_counties = sorted(by_county.values(), key=lambda x: x['dems_rej_pct'] or 0, reverse=True)[:5]
 
     print('  Highest number of rejected Democratic ballots')
     for county in highest_dem_rej_counties:
@@ -140,49 +185,180 @@ def main():
 
     print('\nMissing first, last, or address:', totals['missing_pk'])
 
-    counties_not_reporting = all_counties - counties_reporting
-    print(len(all_counties - counties_reporting), 'counties not reporting any rejections to the SoS:', )
+    counties_not_reporting = set(by_county.keys()) - set(report['counties_reporting'])
+    print(len(counties_not_reporting), 'counties not reporting any rejections to the SoS:', )
     counties = []
     for county_code in counties_not_reporting:
         total_received = by_county[county_code]['dems_rec'] + by_county[county_code]['reps_rec'] + by_county[county_code]['oths_rec']
         counties.append((code_county_map[county_code]["name"], total_received))
     counties = sorted(counties, key=lambda x: x[1], reverse=True)
     for county in counties:
-        print(f'{county[0]}: {county[1]} ballots received') 
+        print(f'{county[0]}: {county[1]} ballots received')
 
-    yob_count = {}
-    party_count = {}
-    method_count = {}
+    print(sorted(report['yob_count'].items(), key=lambda x: x[1], reverse=True))
 
-    for k, v in req_tues.items():
-        if yob_count.get(v['DATE_OF_BIRTH'].split('/')[2]):
-            yob_count[v['DATE_OF_BIRTH'].split('/')[2]] += 1
-        else:
-            yob_count[v['DATE_OF_BIRTH'].split('/')[2]] = 1
+    print(report['yob_count'])
+    print(report['party_count'])
+    print(report['method_count'])
+
+
+def write_json(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
 
-        if party_count.get(v['POLITICAL_PARTY']):
-            party_count[v['POLITICAL_PARTY']] += 1
-        else:
-            party_count[v['POLITICAL_PARTY']] = 1
 
-        if method_count.get(v['ABSENTEE_ISSUE_METHOD']):
-            method_count[v['ABSENTEE_ISSUE_METHOD']] += 1
+def write_csv(report, path):
+    # one row per county
+    columns = ['code', 'name'] + [
+        f'{key}{suffix}' for key in parties for suffix in ['', '_rec', '_rej', '_rtn_pct', '_rej_pct']
+    ]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for county in report['by_county'].values():
+            writer.writerow({column: county[column] for column in columns})
+
+
+def build_report(day, streaming=False):
+    if streaming:
+        digest = new_digest()
+
+        # shockingly these files are not well-encoded
+        with open_csv(f'csvs/sos/{day}.csv') as f:
+            for row in csv.DictReader(f):
+                tally_row(digest, row)
+
+        return summarize(digest)
+
+    # numpy is only needed for the columnar engine, process_sos_csv.py only uses tally_row
+    from digest_engine import aggregate
+    return aggregate(f'csvs/sos/{day}.csv')
+
+
+def source_key(day):
+    # a day's report is reused for as long as its SoS file has not been replaced or edited
+    stat = os.stat(f'csvs/sos/{day}.csv')
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def load_cached_report(day):
+    try:
+        with open(f'{cache_dir}/{day}.json') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cached['report'] if cached.get('source') == source_key(day) else None
+
+
+def save_cached_report(day, report):
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    with open(f'{cache_dir}/{day}.json', 'w') as f:
+        json.dump({'source': source_key(day), 'report': report}, f, separators=(',', ':'))
+
+
+def cached_report(day, streaming=False):
+    report = load_cached_report(day)
+    if report is None:
+        print(f'Parsing {day}.csv...')
+        report = build_report(day, streaming)
+        save_cached_report(day, report)
+    return report
+
+
+def trend(days, county_name=None, streaming=False):
+    """
+    Day-over-day totals across days (optionally for one county), only parsing the days that are not cached.
+    """
+    if county_name and county_name not in county_names:
+        raise ValueError(f'Unknown county: {county_name}')
+
+    rows = []
+    previous = None
+    for day in days:
+        report = cached_report(day, streaming)
+        if county_name:
+            # every county is in every report, zeroed if it has no rows that day
+            counts = next(v for v in report['by_county'].values() if v['name'] == county_name)
         else:
-            method_count[v['ABSENTEE_ISSUE_METHOD']] = 1
+            counts = report['totals']
+
+        tracked = sum([counts[key] for key in parties])
+        received = sum([counts[f'{key}_rec'] for key in parties])
+        rejected = sum([counts[f'{key}_rej'] for key in parties])
+        row = {
+            'day': day,
+            'tracked': tracked,
+            'received': received,
+            'rejected': rejected,
+            'return_pct': pct(received, tracked),
+            'rejection_rate': pct(rejected, received),
+            'new_received': received - previous['received'] if previous else None,
+            'new_rejected': rejected - previous['rejected'] if previous else None,
+        }
+        for key in parties:
+            row[f'{key}_rtn_pct'] = counts[f'{key}_rtn_pct']
+            row[f'{key}_rej_pct'] = counts[f'{key}_rej_pct']
+        rows.append(row)
+        previous = row
+    return rows
 
-    ts = []
-    for k, v in yob_count.items():
-        ts.append((k, v))
 
-    print(sorted(ts, key=lambda x: x[1], reverse=True))
+def days_in_range(day_range):
+    # e.g. 10-01:10-31, MM-DD sorts chronologically within the election year
+    start, _, end = day_range.partition(':')
+    days = sorted([path.stem for path in pathlib.Path('csvs/sos').glob('??-??.csv')])
+    return [day for day in days if start <= day <= (end or start)]
+
+
+def print_trend(rows):
+    print(f'{"day":<8}{"tracked":>10}{"received":>10}{"rtn %":>8}{"rejected":>10}{"rej %":>8}{"+rec":>8}{"+rej":>8}')
+    for row in rows:
+        print(
+            f'{row["day"]:<8}{row["tracked"]:>10}{row["received"]:>10}{row["return_pct"] or 0:>8}'
+            f'{row["rejected"]:>10}{row["rejection_rate"] or 0:>8}'
+            f'{row["new_received"] if row["new_received"] is not None else "":>8}'
+            f'{row["new_rejected"] if row["new_rejected"] is not None else "":>8}'
+        )
+
+
+def main():
+    if args.trend:
+        rows = trend(days_in_range(args.trend), args.county, args.streaming)
+        if args.json:
+            write_json(rows, args.json)
+        if args.csv:
+            with open(args.csv, 'w', newline='') as f:
+                writer = csv.DictWriter(f, rows[0].keys() if rows else ['day'])
+                writer.writeheader()
+                writer.writerows(rows)
+        if not args.json and not args.csv:
+            print_trend(rows)
+        return
+
+    report = cached_report(args.day, args.streaming)
 
-    print(yob_count)
-    print(party_count)
-    print(method_count)
+    if args.json:
+        write_json(report, args.json)
+    if args.csv:
+        write_csv(report, args.csv)
+    if not args.json and not args.csv:
+        print_report(report)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-d', dest='day', required=True)
+    parser.add_argument('-d', dest='day')
+    # report day-over-day totals for a range of days instead, e.g. -t 10-01:10-31, optionally for one county (-k Polk)
+    parser.add_argument('-t', dest='trend')
+    parser.add_argument('-k', dest='county')
+    # write the report as JSON and / or a per-county CSV instead of printing it
+    parser.add_argument('-j', dest='json')
+    parser.add_argument('-c', dest='csv')
+    # tally one row at a time instead of using the columnar engine in digest_engine.py
+    parser.add_argument('-s', dest='streaming', action='store_true', default=False)
     args = parser.parse_args()
+    if not args.day and not args.trend:
+        parser.error('one of -d or -t is required')
+    if args.county and args.county not in county_names:
+        parser.error(f'-k {args.county} is not an Iowa county, e.g. -k Polk or -k "Cerro Gordo"')
     main()
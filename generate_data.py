@@ -0,0 +1,294 @@
+import csv
+import argparse
+import datetime
+import pathlib
+import random
+import string
+from constants import sos_csv_headers, code_county_map, counties_not_reporting
+
+"""
+Writes synthetic SoS daily CSVs and Polk, Cerro Gordo and Des Moines county CSVs for a run of consecutive days,
+e.g. `python3 generate_data.py -v 100000 -n 3 -d 10-01` writes bench/csvs/sos/10-01.csv ... bench/csvs/polk/10-03.csv.
+
+Every voter has a unique last name, so the county CSVs always match exactly one voter and
+ingest_county.py never has to ask for a registration number.
+"""
+
+first_names = [
+    'MARY', 'JAMES', 'PATRICIA', 'JOHN', 'JENNIFER', 'ROBERT', 'LINDA', 'MICHAEL', 'ELIZABETH', 'WILLIAM',
+    'BARBARA', 'DAVID', 'SUSAN', 'RICHARD', 'JESSICA', 'JOSEPH', 'SARAH', 'THOMAS', 'KAREN', 'CHARLES'
+]
+
+last_names = [
+    'SMITH', 'JOHNSON', 'MILLER', 'ANDERSON', 'NELSON', 'PETERSON', 'WILSON', 'MOORE', 'THOMPSON', 'CLARK',
+    'SCHMIDT', 'LARSON', 'MEYER', 'HANSEN', 'OLSON', 'JENSEN', 'BROWN', 'DAVIS', 'JONES', 'MARTIN'
+]
+
+streets = ['MAIN', 'OAK', 'MAPLE', 'ELM', 'WALNUT', 'LOCUST', 'GRAND', 'PARK', 'HIGHLAND', 'UNIVERSITY']
+street_suffixes = ['ST', 'AVE', 'DR', 'RD', 'CT']
+parties = ['Democrat', 'Republican', 'No Party', 'Libertarian']
+party_weights = [40, 35, 23, 2]
+reject_reasons = ['Defective Affidavit/Envelope', 'Deficient Affidavit/ Incomplete']
+
+# Polk is by far the largest county, give it a proportional share of voters
+county_weights = {code: 15 if v['name'] == 'Polk' else 1 for code, v in code_county_map.items()}
+
+# share of each day's churn by event, the remainder are edits to a voter's contact details
+new_voter_share = 0.4
+receive_share = 0.4
+cure_share = 0.1
+remove_share = 0.02
+
+
+def encode_id(voter_id):
+    # voter ID => letters so that last names are unique but still look like names
+    letters = ''
+    while voter_id:
+        voter_id, r = divmod(voter_id, 26)
+        letters += string.ascii_uppercase[r]
+    return letters
+
+
+def format_date(date):
+    return date.strftime('%m/%d/%Y')
+
+
+def new_voter(voter_id, day):
+    county_code = random.choices(list(county_weights.keys()), list(county_weights.values()))[0]
+    request_date = day - datetime.timedelta(days=random.randint(1, 30))
+    voter = {
+        'id': voter_id,
+        'county_code': county_code,
+        'first_name': random.choice(first_names),
+        'middle_name': random.choice(first_names) if random.random() < 0.6 else '',
+        'last_name': random.choice(last_names) + encode_id(voter_id),
+        'address': f'{random.randint(100, 9999)} {random.choice(streets)} {random.choice(street_suffixes)}',
+        'city': code_county_map[county_code]['name'].upper(),
+        'zip': str(random.randint(50001, 52809)),
+        'phone': f'515{random.randint(1000000, 9999999)}' if random.random() < 0.5 else '',
+        'party': random.choices(parties, party_weights)[0],
+        'date_of_birth': format_date(datetime.date(random.randint(1930, 2002), random.randint(1, 12), random.randint(1, 28))),
+        'precinct': f'{county_code}{random.randint(1, 40):03}',
+        # each ballot is [is_void, request_date, sent_date, received_date, ballot_status]
+        'ballots': [],
+        'rejected': False,
+        'reject_reason': None,
+    }
+    issue_ballot(voter, request_date)
+    if random.random() < args.void_rate:
+        # a spoiled or replaced ballot, voided and reissued
+        voter['ballots'][0][0] = '1'
+        issue_ballot(voter, request_date + datetime.timedelta(days=random.randint(1, 5)))
+    if random.random() < args.multi_rate:
+        # a duplicate request that is still active
+        issue_ballot(voter, request_date + datetime.timedelta(days=random.randint(1, 5)))
+    return voter
+
+
+def issue_ballot(voter, request_date):
+    sent_date = request_date + datetime.timedelta(days=random.randint(1, 4))
+    voter['ballots'].append(['0', format_date(request_date), format_date(sent_date), '', ''])
+
+
+def active_ballot(voter):
+    return [ballot for ballot in voter['ballots'] if ballot[0] == '0'][-1]
+
+
+def receive(voter, day):
+    ballot = active_ballot(voter)
+    if ballot[3]:
+        return False
+    ballot[3] = format_date(day)
+    return True
+
+
+def reject(voter):
+    ballot = active_ballot(voter)
+    if not ballot[3] or voter['rejected']:
+        return False
+    voter['rejected'] = True
+    voter['reject_reason'] = random.choice(reject_reasons)
+    # counties that do not report to the SoS only list their rejections in their own CSVs
+    if code_county_map[voter['county_code']]['name'] not in counties_not_reporting:
+        ballot[4] = voter['reject_reason']
+    return True
+
+
+def cure(voter, day):
+    if not voter['rejected']:
+        return False
+    voter['rejected'] = False
+    if code_county_map[voter['county_code']]['name'] not in counties_not_reporting:
+        # the rejected ballot is voided and a new ballot is received
+        active_ballot(voter)[0] = '1'
+        issue_ballot(voter, day - datetime.timedelta(days=2))
+        active_ballot(voter)[3] = format_date(day)
+    return True
+
+
+def receive_and_review(voter, day):
+    if receive(voter, day) and random.random() < args.reject_rate:
+        reject(voter)
+
+
+def edit(voter):
+    if random.random() < 0.5:
+        voter['address'] = f'{random.randint(100, 9999)} {random.choice(streets)} {random.choice(street_suffixes)}'
+    else:
+        voter['phone'] = f'515{random.randint(1000000, 9999999)}'
+    return True
+
+
+def churn(voters, day, next_id):
+    """
+    Apply one day of changes, returns the next unused voter ID.
+    """
+    number_of_events = int(len(voters) * args.churn)
+
+    for _ in range(int(number_of_events * new_voter_share)):
+        voters[next_id] = new_voter(next_id, day)
+        next_id += 1
+
+    voter_ids = random.sample(list(voters.keys()), min(len(voters), number_of_events))
+    for voter_id in voter_ids:
+        voter = voters[voter_id]
+        event = random.random()
+        if event < remove_share:
+            del voters[voter_id]
+        elif event < remove_share + receive_share:
+            receive_and_review(voter, day)
+        elif event < remove_share + receive_share + cure_share:
+            cure(voter, day) or edit(voter)
+        else:
+            edit(voter)
+
+    return next_id
+
+
+def sos_rows(voter):
+    for i, (is_void, request_date, sent_date, received_date, ballot_status) in enumerate(voter['ballots']):
+        row = {
+            'COUNTY_CODE': str(int(voter['county_code'])),
+            'ELECTION_DATE': '11/03/2020',
+            'PRECINCT_CODE': voter['precinct'],
+            'POLITICAL_PARTY': voter['party'],
+            'IS_VOID': is_void,
+            'REQUEST_DATE': request_date,
+            'SENT_DATE': sent_date,
+            'RECEIVED_DATE': received_date,
+            'VOTER_ID': str(voter['id']),
+            'STATUS': 'Active',
+            'FIRST_NAME': voter['first_name'],
+            'MIDDLE_NAME': voter['middle_name'],
+            'LAST_NAME': voter['last_name'],
+            'RESIDENTIAL_ADDRESS_LINE_1': voter['address'],
+            'CT_CITY': voter['city'],
+            'CT_ST_STATE': 'IA',
+            'ZIP_ZIP_CODE': voter['zip'],
+            'HOME_PHONE': voter['phone'],
+            'ABSENTEE_SEQUENCE_NUMBER': f'{voter["id"]}{i + 1}',
+            'ABSENTEE_ISSUE_METHOD': 'Mailing',
+            'RECEIVE_METHOD': 'Mail' if received_date else '',
+            'DATE_OF_BIRTH': voter['date_of_birth'],
+            'MAIL_ADDRESS': '',
+            'MAIL_CITY': '',
+            'MAIL_STATE': '',
+            'MAIL_ZIP': '',
+            'MAIL_ZIP_PLUS': '',
+            'BALLOT_STATUS': ballot_status,
+        }
+        yield [row.get(header, '') for header in sos_csv_headers.keys()]
+
+
+def write_sos(voters, day_name):
+    path = pathlib.Path(f'{args.root}/csvs/sos/{day_name}.csv')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    number_of_rows = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(sos_csv_headers.keys())
+        for voter in voters.values():
+            for row in sos_rows(voter):
+                writer.writerow(row)
+                number_of_rows += 1
+    print(f'Wrote {path} ({len(voters)} voters, {number_of_rows} rows)')
+
+
+def write_counties(voters, day, day_name):
+    rejected = {'Polk': [], 'Cerro Gordo': [], 'Des Moines': []}
+    for voter in voters.values():
+        county = code_county_map[voter['county_code']]['name']
+        if voter['rejected'] and county in rejected:
+            rejected[county].append(voter)
+
+    for county, county_voters in rejected.items():
+        path = pathlib.Path(f'{args.root}/csvs/{county.lower().replace(" ", "_")}/{day_name}.csv')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if county == 'Des Moines' and not county_voters:
+            # ingest_county.py requires an integer first column which an empty file cannot provide
+            path.unlink(missing_ok=True)
+            continue
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            if county == 'Polk':
+                writer.writerow(['Last', 'First', 'Middle', 'Address', 'Zip', 'State', 'CITY', 'Date', 'situation'])
+                for voter in county_voters:
+                    writer.writerow([
+                        voter['last_name'], voter['first_name'], '', voter['address'], voter['zip'], 'IA',
+                        voter['city'], format_date(day), 'Deficient'
+                    ])
+            elif county == 'Cerro Gordo':
+                writer.writerow(['Last', 'First', 'Middle', 'request #', 'fax/email', 'original rec\'d', 'situation', 'Address', 'City State Zip'])
+                for voter in county_voters:
+                    writer.writerow([
+                        voter['last_name'], f'{voter["first_name"]} {voter["middle_name"]}'.strip(), '', voter['id'], '',
+                        active_ballot(voter)[3], voter['reject_reason'], voter['address'], f'{voter["city"]} IA {voter["zip"]}'
+                    ])
+            else:
+                writer.writerow(['Voter ID'])
+                for voter in county_voters:
+                    writer.writerow([voter['id']])
+        print(f'Wrote {path} ({len(county_voters)} rejected)')
+
+
+def main():
+    random.seed(args.seed)
+    day = datetime.datetime.strptime(f'2020-{args.day}', '%Y-%m-%d').date()
+
+    voters = {}
+    next_id = 100000
+    for _ in range(args.number_of_voters):
+        voters[next_id] = new_voter(next_id, day)
+        next_id += 1
+
+    # ballots received and rejected before the first file
+    for voter in voters.values():
+        if random.random() < 0.4:
+            receive_and_review(voter, day - datetime.timedelta(days=random.randint(1, 10)))
+
+    for i in range(args.number_of_days):
+        if i > 0:
+            day += datetime.timedelta(days=1)
+            next_id = churn(voters, day, next_id)
+        day_name = day.strftime('%m-%d')
+        write_sos(voters, day_name)
+        write_counties(voters, day, day_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', dest='number_of_voters', type=int, default=100000)
+    parser.add_argument('-n', dest='number_of_days', type=int, default=3)
+    parser.add_argument('-d', dest='day', default='10-01')
+    # directory the csvs/ tree is written under, keep synthetic data away from the real csvs/
+    parser.add_argument('-o', dest='root', default='bench')
+    parser.add_argument('-s', dest='seed', type=int, default=0)
+    # share of new voters with a voided ballot or a second active ballot, and share of received ballots rejected
+    parser.add_argument('--void-rate', dest='void_rate', type=float, default=0.03)
+    parser.add_argument('--multi-rate', dest='multi_rate', type=float, default=0.01)
+    parser.add_argument('--reject-rate', dest='reject_rate', type=float, default=0.02)
+    # share of voters that change day over day (new requests, receipts, rejections, cures, edits, removals)
+    parser.add_argument('--churn', dest='churn', type=float, default=0.05)
+    args = parser.parse_args()
+
+    main()
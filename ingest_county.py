@@ -2,15 +2,16 @@ import csv
 import argparse
 import logging
 import os
-import codecs
 import pandas as pd
 import pathlib
 import sys
 import traceback
 from fuzzywuzzy import fuzz
+from psycopg2 import Error as DatabaseError
 from dotenv import load_dotenv
+import services
 from services import Postgres
-from common import replace_bom, yes_no, pk_string, get_voter
+from common import open_csv, yes_no, pk_string, get_voter
 from constants import display_names
 
 
@@ -19,7 +20,7 @@ def insert_county_id(cursor, row, address_start, registration_number):
         'INSERT INTO county_ids (last_name, first_name, middle_name, address_start, registration_number) '
         'VALUES (%s, %s, %s, %s, %s)'
     )
-    cursor.execute(query, (row['Last'], row['First'], row['Middle'], address_start, registration_number))
+    cursor.execute_prepared('insert_county_id', query, (row['Last'], row['First'], row['Middle'], address_start, registration_number))
 
 
 def search_by_address(cursor, query_args):
@@ -30,7 +31,7 @@ def search_by_address(cursor, query_args):
         'AND first_name = %s '
         'AND address_start = %s'
     )
-    cursor.execute(query, query_args)
+    cursor.execute_prepared('search_county_ids_by_address', query, query_args)
     return cursor.fetchone()
 
 
@@ -44,9 +45,11 @@ def search_by_name(cursor, query_args, middle_name):
     if middle_name:
         query += 'AND middle_name = %s '
         query_args += (middle_name,)
+        name = 'search_county_ids_by_name_middle'
     else:
         query += 'AND middle_name IS NULL '
-    cursor.execute(query, query_args)
+        name = 'search_county_ids_by_name'
+    cursor.execute_prepared(name, query, query_args)
     return cursor.fetchone()
 
 
@@ -57,11 +60,15 @@ def get_voter_registration_number(cursor, match):
             'FROM voters '
             'WHERE registration_number = %s'
         )
-        cursor.execute(query, (dict(match)['registration_number'],))
+        cursor.execute_prepared('get_voter', query, (dict(match)['registration_number'],))
         return dict(cursor.fetchone())
 
 
 def ask_jeeves(cursor, row, rejected_address_start):
+    # nothing has been written for this row yet, commit the rows before it rather than holding their locks
+    # in an idle transaction (and blocking SoS ingest) while waiting on a human
+    if not cursor.connection.autocommit:
+        cursor.commit()
     while True:
         registration_number = input('Please provide the correct registration number for this voter (s to skip): ')
         if registration_number == 's':
@@ -75,6 +82,9 @@ def ask_jeeves(cursor, row, rejected_address_start):
             tb = traceback.TracebackException.from_exception(e)
             logging.error(' | '.join(['ERROR', str(row), ''.join(tb.format())]))
             print(''.join(tb.format()))
+            # a failed statement aborts the open batch, retrying inside it cannot succeed
+            if isinstance(e, DatabaseError) and not cursor.connection.autocommit:
+                raise
 
 
 def get_matches(matches, cursor, row, address):
@@ -92,10 +102,10 @@ def find_by_registration_number(cursor, registration_number):
         query = (
             'SELECT * '
             'FROM voters '
-            'WHERE registration_number = %s '
+            'WHERE registration_number = %s'
         )
 
-        cursor.execute(query, (registration_number,))
+        cursor.execute_prepared('get_voter', query, (registration_number,))
         result = cursor.fetchone()
         return dict(result) if result else None
 
@@ -117,17 +127,19 @@ def find_by_name_and_address(cursor, row):
             'FROM voters '
             'WHERE last_name = %s '
             'AND first_name = %s '
-            'AND county = %s'
+            'AND county = %s '
         )
 
         if row['Middle']:
             query += 'AND middle_name = %s '
             query_args =  (row['Last'], row['First'], county, row['Middle'])
+            name = 'find_in_county_by_name_middle'
         else:
             query += 'AND middle_name IS NULL '
             query_args =  (row['Last'], row['First'], county)
+            name = 'find_in_county_by_name_no_middle'
 
-        cursor.execute(query, query_args)
+        cursor.execute_prepared(name, query, query_args)
         matches = [dict(existing_row) for existing_row in cursor.fetchall()]
         return get_matches(matches, cursor, row, '')
 
@@ -138,7 +150,7 @@ def find_by_name_and_address(cursor, row):
         'AND first_name = %s '
         'AND county = %s'
     )
-    cursor.execute(query, (row['Last'], row['First'], county))
+    cursor.execute_prepared('find_in_county_by_name', query, (row['Last'], row['First'], county))
     existing_rows = [dict(existing_row) for existing_row in cursor.fetchall()]
 
     matches = []
@@ -191,6 +203,7 @@ def set_rejected(cursor, row):
                 'WHERE id = %s'
             )
             query_args = (reject_date, cure_date, 1, True, True, row['situation'], row['situation'], logs, log, 'Mail', existing_row['id'])
+            name = 'set_rejected_by_mail'
         else:
             query = (
                 'UPDATE voters '
@@ -198,7 +211,8 @@ def set_rejected(cursor, row):
                 'WHERE id = %s'
             )
             query_args = (reject_date, cure_date, 1, True, True, row['situation'], row['situation'], logs, log, existing_row['id'])
-        cursor.execute(query, query_args)
+            name = 'set_rejected'
+        cursor.execute_prepared(name, query, query_args)
 
     return existing_row['registration_number']
 
@@ -226,7 +240,7 @@ def cure(cursor, cured_voter_ids):
         'WHERE registration_number = %s'
     )
     for voter_id in cured_voter_ids:
-        cursor.execute(find_query, (voter_id,))
+        cursor.execute_prepared('get_voter', find_query, (voter_id,))
         cured_voter = dict(cursor.fetchone())
 
         logs = cured_voter.get('logs')
@@ -234,7 +248,8 @@ def cure(cursor, cured_voter_ids):
         logs.append(' | '.join([f'{county}-{args.day}.csv', 'UPDATE', display_names['ballot_status'], f'{cured_voter.get("ballot_status")} => None']))
         log = '\n'.join(logs)
 
-        cursor.execute(update_query, (f'2020-{args.day}', False, None, logs, log, voter_id))
+        cursor.execute_prepared('cure_voter', update_query, (f'2020-{args.day}', False, None, logs, log, voter_id))
+        cursor.checkpoint(f'cure {voter_id}')
 
 
 def check_headers_and_pks(row):
@@ -275,7 +290,8 @@ def clean_row(row):
 
 
 def handle_des_moines(path):
-    df = pd.read_csv(path)
+    # utf-8-sig drops the leading BOM present in many Excel documents and CSVs exported from Excel
+    df = pd.read_csv(path, encoding='utf-8-sig')
     registration_numbers = df.iloc[:, 0]
     if registration_numbers.dtypes != int:
         sys.exit('First column was not registration numbers')
@@ -291,25 +307,23 @@ def handle_des_moines(path):
 
 
 def main():
-    # remove the leading BOM present in many Excel documents and CSVs exported from Excel
-    replace_bom(path)
-
     if county == 'Des Moines':
         rows = handle_des_moines(path)
     else:
         rows = []
-        with codecs.open(path, encoding='utf-8', errors='ignore') as f:
+        with open_csv(path) as f:
             for row in csv.DictReader(f):
                 clean = clean_row(row)
                 check_headers_and_pks(clean)
                 rows.append(clean)
 
-    with Postgres(**postgres_args) as cursor:
+    with Postgres(**postgres_args, batch_size=args.batch_size, batch_seconds=args.batch_seconds) as cursor:
         rejected_voter_ids = get_rejected_voter_ids(cursor)
 
         # update logs and DB with rejected voters
-        for row in rows:
+        for i, row in enumerate(rows):
             voter_id = set_rejected(cursor, row)
+            cursor.checkpoint(f'row {i + 1} of {len(rows)} ({voter_id})')
             # -1 => problem trying to match this record
             if voter_id < 0:
                 continue
@@ -324,6 +338,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', dest='day', required=True)
     parser.add_argument('-c', dest='county', choices=['Cerro Gordo', 'Des Moines', 'Polk'], required=True)
+    # commit every N writes or T seconds, -b 0 -s 0 autocommits every statement
+    parser.add_argument('-b', dest='batch_size', type=int, default=500)
+    parser.add_argument('-s', dest='batch_seconds', type=float, default=5)
+    # time every statement and write logs/timing-<county>-<day>.json, logging statements slower than -l seconds
+    parser.add_argument('-t', dest='timing', action='store_true', default=False)
+    parser.add_argument('-l', dest='slow_seconds', type=float, default=1.0)
     args = parser.parse_args()
 
     # ensure log dirs
@@ -358,4 +378,10 @@ if __name__ == '__main__':
 
     pks = ['Last', 'First']
 
-    main()
+    if args.timing:
+        services.enable_timing(args.slow_seconds)
+    try:
+        main()
+    finally:
+        if args.timing:
+            services.timing.write(f'{log_dir}/timing-{county}-{args.day}.json')
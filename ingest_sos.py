@@ -0,0 +1,169 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import pathlib
+import subprocess
+import sys
+import time
+import traceback
+import redis
+from dotenv import load_dotenv
+from common import yes_no
+
+"""
+Runs process_sos_csv.py and then ingests every chunk in parallel on a process pool.
+Replaced ingest_sos.sh, which needed macOS Terminal windows and could not tell when a chunk failed.
+
+    python3 ingest_sos.py -d 10-08 -n 10 [-p] [-m] [-f] [-r] [-g] [-c 10-07] [-w 4] [-x 20] [-b 500] [-s 5] [-t] [-l 1]
+"""
+
+# how often (in voters) each worker sends its progress back to the console
+report_interval = 500
+
+
+def ingest_chunk(day, chunk, is_prod, merge, force, resume, batch_size, batch_seconds, timing, slow_seconds, postgres_args,
+                 progress):
+    # every chunk runs in a fresh worker process (maxtasksperchild=1), so ingest_sos_chunk's module state
+    # (staged_voters, args, the logging config, the connection pool) never carries over from a previous chunk
+    import ingest_sos_chunk
+
+    log_dir = 'logs' if is_prod else 'dev_logs'
+    logging.basicConfig(filename=f'{log_dir}/SoS-{day}.log', format='%(asctime)s | %(message)s', level=logging.INFO)
+
+    ingest_sos_chunk.args = argparse.Namespace(
+        day=day, chunk=chunk, is_prod=is_prod, merge=merge, force=force, resume=resume,
+        batch_size=batch_size, batch_seconds=batch_seconds, timing=timing, slow_seconds=slow_seconds)
+    ingest_sos_chunk.postgres_args = postgres_args
+    ingest_sos_chunk.redis_client = redis.StrictRedis(host='localhost', decode_responses=True)
+
+    start = time.time()
+    processed = 0
+
+    def report(i, total):
+        nonlocal processed
+        processed = i
+        if i % report_interval == 0:
+            progress.put((chunk, i, total, time.time() - start))
+
+    try:
+        ingest_sos_chunk.main(report=report)
+        return chunk, True, processed, time.time() - start, None
+    except Exception as e:
+        tb = traceback.TracebackException.from_exception(e)
+        logging.error(f'ERROR | chunk {chunk} | {"".join(tb.format())}')
+        return chunk, False, processed, time.time() - start, ''.join(tb.format())
+
+
+def print_progress(status):
+    processed = sum([i for i, _, _ in status.values()])
+    totals = [total for _, total, _ in status.values()]
+    of_total = f' of {sum(totals)}' if totals and None not in totals else ''
+    rates = ' '.join([
+        f'[{chunk}] {round(i / seconds) if seconds else 0}/s'
+        for chunk, (i, _, seconds) in sorted(status.items())
+    ])
+    print(f'Processed {processed}{of_total} voters... {rates}', end='\r')
+
+
+def main():
+    # re-chunking would invalidate the saved offsets, so a resume reuses the existing chunk files
+    if not args.resume:
+        print('Processing SoS CSV...')
+        command = [sys.executable, 'process_sos_csv.py', '-d', args.day, '-n', str(args.number_of_chunks)]
+        if args.is_prod:
+            command.append('-p')
+        if args.digest:
+            command.append('-g')
+        if args.base_day:
+            command += ['-b', args.base_day]
+        if subprocess.run(command).returncode != 0:
+            print('process_sos_csv.py failed, no chunks were ingested')
+            return 1
+
+    # one DB connection per worker, leave room for everyone else on the instance
+    workers = min(args.workers or os.cpu_count() or 1, args.max_connections, args.number_of_chunks)
+    print(f'Ingesting {args.number_of_chunks} chunks with {workers} workers...')
+
+    manager = multiprocessing.Manager()
+    progress = manager.Queue()
+    chunks = [
+        (args.day, chunk, args.is_prod, args.merge, args.force, args.resume, args.batch_size, args.batch_seconds,
+         args.timing, args.slow_seconds, postgres_args, progress)
+        for chunk in range(1, args.number_of_chunks + 1)
+    ]
+
+    status = {}
+    with multiprocessing.Pool(workers, maxtasksperchild=1) as pool:
+        result = pool.starmap_async(ingest_chunk, chunks)
+        while not result.ready() or not progress.empty():
+            while not progress.empty():
+                chunk, i, total, seconds = progress.get()
+                status[chunk] = (i, total, seconds)
+            print_progress(status)
+            result.wait(1)
+        results = result.get()
+
+    print()
+    failed = []
+    for chunk, ok, processed, seconds, error in sorted(results):
+        print(f'Chunk {chunk}: {"done" if ok else "FAILED"} | {processed} voters in {round(seconds)}s')
+        if not ok:
+            print(error)
+            failed.append(chunk)
+
+    if failed:
+        print('Failed chunks:', ', '.join([str(chunk) for chunk in failed]))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', dest='day', required=True)
+    parser.add_argument('-n', dest='number_of_chunks', type=int, default=10)
+    parser.add_argument('-p', dest='is_prod', action='store_true', default=False)
+    parser.add_argument('-m', dest='merge', action='store_true', default=False)
+    parser.add_argument('-f', dest='force', action='store_true', default=False)
+    # skip process_sos_csv.py and resume every chunk from its last commit
+    parser.add_argument('-r', dest='resume', action='store_true', default=False)
+    # print the digest_sos.py report from process_sos_csv.py's pass over the file
+    parser.add_argument('-g', dest='digest', action='store_true', default=False)
+    # only ingest voters added or changed since this day's SoS file (the last day ingested)
+    parser.add_argument('-c', dest='base_day')
+    parser.add_argument('-w', dest='workers', type=int, default=None)
+    parser.add_argument('-x', dest='max_connections', type=int, default=20)
+    parser.add_argument('-b', dest='batch_size', type=int, default=500)
+    parser.add_argument('-s', dest='batch_seconds', type=float, default=5)
+    # time every statement, each chunk writes logs/timing-SoS-<day>-<chunk>.json
+    parser.add_argument('-t', dest='timing', action='store_true', default=False)
+    parser.add_argument('-l', dest='slow_seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.is_prod and not yes_no('Are you sure you want to target production?'):
+        sys.exit(0)
+
+    # ensure log dirs
+    pathlib.Path('logs/').mkdir(exist_ok=True)
+    pathlib.Path('dev_logs/').mkdir(exist_ok=True)
+
+    load_dotenv()
+
+    if args.is_prod:
+        postgres_args = {
+            'host': os.getenv('POSTGRES_HOST'),
+            'port': int(os.getenv('POSTGRES_PORT')),
+            'user': os.getenv('POSTGRES_USER'),
+            'password': os.getenv('POSTGRES_PASSWORD'),
+            'dbname': os.getenv('POSTGRES_DB'),
+        }
+    else:
+        postgres_args = {
+            'host': os.getenv('DEV_POSTGRES_HOST'),
+            'port': int(os.getenv('DEV_POSTGRES_PORT')),
+            'user': os.getenv('DEV_POSTGRES_USER'),
+            'password': os.getenv('DEV_POSTGRES_PASSWORD'),
+            'dbname': os.getenv('DEV_POSTGRES_DB'),
+        }
+
+    sys.exit(main())
@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 from pathlib import Path
 from services import Postgres
 from common import yes_no
+from migrate import migrate
 
 
 def main():
@@ -13,6 +14,8 @@ def main():
     with Postgres(**postgres_args) as cursor:
         with open('schema.sql') as f:
             cursor.execute(f.read())
+        # the tables were just recreated, so every migration (e.g. the indexes) is applied and recorded
+        migrate(cursor)
 
 
 if __name__ == '__main__':
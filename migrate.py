@@ -0,0 +1,342 @@
+import argparse
+import json
+import os
+from dotenv import load_dotenv
+from services import Postgres
+from common import yes_no
+
+"""
+Versioned, non-destructive schema changes.
+
+schema.sql (initialize.py) still builds a database from scratch, migrations bring an existing one up to date
+without dropping anything and record each version applied in schema_migrations:
+
+    python3 migrate.py       # apply every migration that has not been applied yet
+    python3 migrate.py -s    # list the migrations and whether they have been applied
+    python3 migrate.py -e    # only EXPLAIN the query shapes of the applied migrations
+
+Indexes are built CONCURRENTLY so ingest can keep writing while they build.
+Each migration lists the query shapes its indexes are for (the SQL from the scripts with sample values).
+After it is applied every shape is EXPLAINed, and the migration is not recorded if one of its indexes cannot serve
+its query. An index the planner skips only because the table is still small is reported but accepted.
+Indexes a migration replaces are dropped, also CONCURRENTLY, once its new indexes are built and before the checks.
+
+To change the schema append a migration with the next version, never edit one that has been applied,
+and keep schema.sql in step for new databases.
+"""
+
+migrations = [
+    {
+        'version': 1,
+        'name': 'add voters.sos_digest',
+        # the digest of a voter's SoS rows that ingest_sos_chunk.py uses to skip unchanged voters
+        'statements': ['ALTER TABLE voters ADD COLUMN IF NOT EXISTS sos_digest TEXT'],
+        'indexes': {},
+        'checks': [],
+        'drop_indexes': [],
+    },
+    {
+        'version': 2,
+        'name': 'index voters by name and address',
+        'statements': [],
+        'indexes': {
+            # also serves any lookup on (last_name, first_name)
+            'voters_name_address_idx': 'voters (last_name, first_name, resident_address)',
+        },
+        'checks': [
+            # common.find_by_name_and_address
+            (
+                'voters_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND resident_address = %s '
+                'AND middle_name IS NULL AND name_suffix IS NULL',
+                ('DOE', 'JANE', '100 MAIN ST'),
+            ),
+            # ingest_county.find_by_name_and_address
+            (
+                'voters_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND county = %s',
+                ('DOE', 'JANE', 'Polk'),
+            ),
+            # append_to_observed_rejections.get_matches
+            (
+                'voters_name_address_idx',
+                'SELECT * FROM voters WHERE first_name = %s AND last_name = %s AND county = %s',
+                ('JANE', 'DOE', 'Polk'),
+            ),
+        ],
+        'drop_indexes': [],
+    },
+    {
+        'version': 3,
+        'name': 'index county_ids by name and address',
+        'statements': [],
+        'indexes': {
+            'county_ids_name_address_idx': 'county_ids (last_name, first_name, address_start)',
+        },
+        'checks': [
+            # ingest_county.search_by_address
+            (
+                'county_ids_name_address_idx',
+                'SELECT registration_number FROM county_ids WHERE last_name = %s AND first_name = %s AND address_start = %s',
+                ('Doe', 'Jane', '100 main'),
+            ),
+            # ingest_county.search_by_name
+            (
+                'county_ids_name_address_idx',
+                'SELECT registration_number FROM county_ids WHERE last_name = %s AND first_name = %s AND middle_name IS NULL',
+                ('Doe', 'Jane'),
+            ),
+        ],
+        'drop_indexes': [],
+    },
+    {
+        'version': 4,
+        'name': 'index voters by county and absentee sequence number',
+        'statements': [],
+        'indexes': {
+            'voters_county_sequence_idx': 'voters (county, absentee_sequence_number)',
+        },
+        'checks': [
+            # append_to_observed_rejections.get_matches
+            (
+                'voters_county_sequence_idx',
+                'SELECT * FROM voters WHERE county = %s AND absentee_sequence_number = %s',
+                ('Polk', '12345'),
+            ),
+        ],
+        'drop_indexes': [],
+    },
+    {
+        'version': 5,
+        'name': 'index voters by reject date and rejected voters by county',
+        'statements': [],
+        'indexes': {
+            'voters_reject_date_idx': 'voters (reject_date)',
+            # only the voters with a ballot status, a small fraction of the table
+            'voters_rejected_county_idx': 'voters (county) WHERE ballot_status IS NOT NULL',
+        },
+        'checks': [
+            # check_van.compare_rejected
+            ('voters_reject_date_idx', 'SELECT * FROM voters WHERE reject_date = %s', ('2020-10-31',)),
+            # ingest_county.get_rejected_voter_ids
+            (
+                'voters_rejected_county_idx',
+                'SELECT registration_number FROM voters WHERE ballot_status IS NOT NULL AND county = %s',
+                ('Polk',),
+            ),
+            # check_van.currently_rejected_case_one
+            (
+                'voters_rejected_county_idx',
+                'SELECT registration_number FROM voters '
+                'WHERE county IN (\'Polk\', \'Cerro Gordo\', \'Des Moines\') AND ballot_status IS NOT NULL',
+                None,
+            ),
+        ],
+        'drop_indexes': [],
+    },
+    {
+        'version': 6,
+        'name': 'index voters by full name and address',
+        'statements': [],
+        'indexes': {
+            # every column common.find_by_name_and_address filters on, the leading (last_name, first_name)
+            # still serves the lookups voters_name_address_idx was for
+            'voters_full_name_address_idx': 'voters (last_name, first_name, resident_address, middle_name, name_suffix)',
+        },
+        'checks': [
+            # common.find_by_name_and_address, one shape per prepared statement
+            (
+                'voters_full_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND resident_address = %s '
+                'AND middle_name IS NULL AND name_suffix IS NULL',
+                ('DOE', 'JANE', '100 MAIN ST'),
+            ),
+            (
+                'voters_full_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND resident_address = %s '
+                'AND middle_name = %s AND name_suffix IS NULL',
+                ('DOE', 'JANE', '100 MAIN ST', 'ANN'),
+            ),
+            (
+                'voters_full_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND resident_address = %s '
+                'AND middle_name IS NULL AND name_suffix = %s',
+                ('DOE', 'JANE', '100 MAIN ST', 'JR'),
+            ),
+            (
+                'voters_full_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND resident_address = %s '
+                'AND middle_name = %s AND name_suffix = %s',
+                ('DOE', 'JANE', '100 MAIN ST', 'ANN', 'JR'),
+            ),
+            # ingest_county.find_by_name_and_address
+            (
+                'voters_full_name_address_idx',
+                'SELECT * FROM voters WHERE last_name = %s AND first_name = %s AND county = %s',
+                ('DOE', 'JANE', 'Polk'),
+            ),
+            # append_to_observed_rejections.get_matches
+            (
+                'voters_full_name_address_idx',
+                'SELECT * FROM voters WHERE first_name = %s AND last_name = %s AND county = %s',
+                ('JANE', 'DOE', 'Polk'),
+            ),
+        ],
+        # a prefix of the new index, keeping it would only slow down every write
+        'drop_indexes': ['voters_name_address_idx'],
+    },
+]
+
+
+def create_migrations_table(cursor):
+    query = (
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, '
+        'name TEXT, '
+        'applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()'
+        ')'
+    )
+    cursor.execute(query)
+
+
+def applied_versions(cursor):
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row['version'] for row in cursor.fetchall()}
+
+
+def create_index(cursor, name, definition):
+    # a CONCURRENTLY build that failed part way leaves an invalid index behind that IF NOT EXISTS would keep
+    query = (
+        'SELECT i.indisvalid '
+        'FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE c.relname = %s'
+    )
+    cursor.execute(query, (name,))
+    existing = cursor.fetchone()
+    if existing and not existing['indisvalid']:
+        print(f'  dropping invalid index {name}')
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+    print(f'  creating index {name} on {definition}...')
+    cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+
+def uses_index(cursor, index, query, params):
+    cursor.execute(f'EXPLAIN (FORMAT JSON) {query}', params)
+    return f'"{index}"' in json.dumps(cursor.fetchone()[0])
+
+
+def check(cursor, migration, dropped=()):
+    """
+    EXPLAIN every query shape of a migration. Returns False if one of its indexes cannot serve its query.
+    Shapes for an index in dropped, replaced by a later migration, are skipped.
+    """
+    ok = True
+    for table in {definition.split()[0] for definition in migration['indexes'].values()}:
+        # fresh statistics, so that the plans are the ones the scripts would get
+        cursor.execute(f'ANALYZE {table}')
+
+    for index, query, params in migration['checks']:
+        if index in dropped:
+            print(f'  {index}: replaced by a later migration')
+            continue
+        if uses_index(cursor, index, query, params):
+            print(f'  {index}: used')
+            continue
+
+        # the planner rightly prefers a sequential scan of a small table, check the index could serve the query at all
+        cursor.execute('SET enable_seqscan = off')
+        try:
+            usable = uses_index(cursor, index, query, params)
+        finally:
+            cursor.execute('RESET enable_seqscan')
+
+        if usable:
+            print(f'  {index}: usable, not chosen at the current table size')
+        else:
+            print(f'  {index}: NOT USED by {query}')
+            ok = False
+    return ok
+
+
+def migrate(cursor):
+    """
+    Apply and record every migration that has not been applied yet, in version order.
+    Returns the versions applied.
+    """
+    create_migrations_table(cursor)
+    applied = applied_versions(cursor)
+    newly_applied = []
+
+    for migration in sorted(migrations, key=lambda m: m['version']):
+        if migration['version'] in applied:
+            continue
+        print(f'Applying {migration["version"]}: {migration["name"]}...')
+        # every statement is idempotent, a migration that failed part way is simply run again
+        for statement in migration['statements']:
+            cursor.execute(statement)
+        for name, definition in migration['indexes'].items():
+            create_index(cursor, name, definition)
+
+        # the replaced indexes go once the new ones are built, so that the checks see the plans without them
+        for name in migration['drop_indexes']:
+            print(f'  dropping index {name}')
+            cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+        if not check(cursor, migration):
+            raise RuntimeError(f'Migration {migration["version"]} was not recorded, an index does not serve its queries')
+
+        cursor.execute(
+            'INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (migration['version'], migration['name']))
+        newly_applied.append(migration['version'])
+
+    return newly_applied
+
+
+def main():
+    with Postgres(**postgres_args) as cursor:
+        if args.status:
+            create_migrations_table(cursor)
+            applied = applied_versions(cursor)
+            for migration in migrations:
+                print(f'{migration["version"]:>4} {"applied" if migration["version"] in applied else "pending":<8} {migration["name"]}')
+        elif args.explain:
+            create_migrations_table(cursor)
+            applied = applied_versions(cursor)
+            dropped = {name for m in migrations if m['version'] in applied for name in m['drop_indexes']}
+            for migration in migrations:
+                if migration['version'] in applied and migration['checks']:
+                    print(f'{migration["version"]}: {migration["name"]}')
+                    check(cursor, migration, dropped)
+        else:
+            versions = migrate(cursor)
+            print(f'Applied {len(versions)} migrations' if versions else 'Up to date')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', dest='status', action='store_true', default=False)
+    parser.add_argument('-e', dest='explain', action='store_true', default=False)
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    is_prod = yes_no('Target production?')
+    if is_prod:
+        postgres_args = {
+            'host': os.getenv('POSTGRES_HOST'),
+            'port': int(os.getenv('POSTGRES_PORT')),
+            'user': os.getenv('POSTGRES_USER'),
+            'password': os.getenv('POSTGRES_PASSWORD'),
+            'dbname': os.getenv('POSTGRES_DB'),
+        }
+    else:
+        postgres_args = {
+            'host': os.getenv('DEV_POSTGRES_HOST'),
+            'port': int(os.getenv('DEV_POSTGRES_PORT')),
+            'user': os.getenv('DEV_POSTGRES_USER'),
+            'password': os.getenv('DEV_POSTGRES_PASSWORD'),
+            'dbname': os.getenv('DEV_POSTGRES_DB'),
+        }
+
+    main()
@@ -1,11 +1,10 @@
 import csv
 import os
-import codecs
 import argparse
 import civis
 from dotenv import load_dotenv
-from services import Postgres
-from common import replace_bom, yes_no
+from services import Postgres, stream_rows
+from common import open_csv, yes_no
 from constants import van_to_clarity
 
 
@@ -38,9 +37,7 @@ def generate_base(for_clarity=False):
         'AND landline IS NULL '
         'AND voters.ballot_status IS NOT NULL'
     )
-    with Postgres(**postgres_args) as cursor:
-        cursor.execute(query)
-        return {dict(row)['van_id']: dict(row) for row in cursor.fetchall()}
+    return {row['van_id']: dict(row) for row in stream_rows(postgres_args, query)}
 
 
 def process_clarity_csv():
@@ -50,11 +47,9 @@ def process_clarity_csv():
         cursor.execute('SELECT * FROM right_numbers')
         right_numbers = {(dict(row)['van_id'], dict(row)['number']) for row in cursor.fetchall()}
 
-    replace_bom('from_clarity.csv')
-
     clarity_dict = {}
 
-    with codecs.open('from_clarity.csv', encoding='utf-8', errors='ignore') as f:
+    with open_csv('from_clarity.csv') as f:
         for row in csv.DictReader(f):
             clarity_phone = row['ts_phone'] if (int(row['van_id']), row['ts_phone']) not in wrong_numbers and row['ts_phone'] != '\\N' else None
             clarity_cell = row['ts_wireless'] if (int(row['van_id']), row['ts_wireless']) not in wrong_numbers and row['ts_wireless'] != '\\N' else None
@@ -127,9 +122,7 @@ def create_for_clarity():
     if os.path.exists('for_clarity.csv'):
         os.remove('for_clarity.csv')
 
-    replace_bom('phones/not_yet_contacted.csv')
-
-    with codecs.open('phones/not_yet_contacted.csv') as f:
+    with open_csv('phones/not_yet_contacted.csv') as f:
         rows = [row for row in csv.DictReader(f) if not row.get('Pref Phone ') or row.get('Pref Phone ').strip() == '']
 
     for_clarity_rows = [{van_to_clarity[k]: v for k, v in row.items() if k in van_to_clarity} for row in rows]
@@ -1,100 +1,291 @@
 import csv
 import argparse
-import codecs
 import pathlib
 import os
 import logging
+import json
+import tempfile
 from dotenv import load_dotenv
-from constants import sos_csv_headers
-from common import replace_bom
+from constants import sos_csv_headers, code_county_map, counties_not_reporting
+from common import open_csv, sos_voter_id, clean_sos_row, batched
 from services import Postgres
+from diff_sos import diff
+from digest_sos import new_digest, tally_row, summarize, print_report, save_cached_report
 
+# relative ingest work per voter, used to balance the chunks so that every worker finishes at about the same time
+cost_weights = {
+    # batched lookup, applying the rules and one write
+    'voter': 1,
+    # a new voter is a whole-row INSERT
+    'new': 1,
+    # every row beyond the first goes through active_void and compare_and_log
+    'row': 0.5,
+    # voided rows are folded into the logs by preprend_logs
+    'void': 0.5,
+    # reject_and_cure only runs for counties that report ballot status to the SoS
+    'reporting': 0.5,
+    # rejected rows update the rejection data
+    'rejected': 1,
+}
 
-def create_chunks(iterable, n):
-    chunks = []
-    for i in range(0, len(iterable), n):
-        chunks.append(iterable[i:i + n])
-    return chunks
+# voters read before one lookup of which of them are already in the DB
+lookup_batch_size = 5000
 
+def voter_cost(rows, is_new):
+    """
+    Predicted ingest work for a voter's rows in cost_weights units.
+    """
+    cost = cost_weights['voter'] + cost_weights['row'] * (len(rows) - 1)
+    if is_new:
+        cost += cost_weights['new']
+    cost += cost_weights['void'] * len([row for row in rows if row.get('IS_VOID') == '1'])
 
-def mark_removed(cursor, row):
-    logging.info(' | '.join([f'SoS-{args.day}.csv', 'REMOVE', 'registration_number', str(row['registration_number'])]))
-    logs = row['logs'] + [' | '.join([f'SoS-{args.day}.csv', 'REMOVE'])]
-    log = '\n'.join(logs)
+    county_code = rows[0].get('COUNTY_CODE', '').zfill(2)
+    if county_code in code_county_map and code_county_map[county_code]['name'] not in counties_not_reporting:
+        cost += cost_weights['reporting']
+        cost += cost_weights['rejected'] * len([row for row in rows if 'Affidavit' in (row.get('BALLOT_STATUS') or '')])
+    return cost
 
+
+def get_existing_voter_ids(cursor, voter_ids):
+    # only the IDs, of only this batch, to tell new voters (a whole-row INSERT) from existing ones
     query = (
-        'UPDATE voters '
-        'SET logs = %s, log = %s, was_removed = true '
-        'WHERE id = %s'
+        'SELECT registration_number '
+        'FROM voters '
+        'WHERE registration_number = ANY(%s)'
     )
-    cursor.execute(query, (logs, log, row['id']))
+    cursor.execute_prepared('get_existing_voter_ids', query, (list(voter_ids),))
+    return {row['registration_number'] for row in cursor.fetchall()}
+
+
+def load_delta_voter_ids(cursor, ids_path):
+    # the IDs diff_sos.py wrote, queried a batch at a time rather than held in a set
+    cursor.execute('CREATE TEMP TABLE delta_voter_ids (registration_number INTEGER PRIMARY KEY, change TEXT)')
+    with open(ids_path) as f:
+        cursor.copy_expert('COPY delta_voter_ids (registration_number, change) FROM STDIN WITH (FORMAT csv, HEADER)', f)
+    cursor.execute('ANALYZE delta_voter_ids')
+
+
+def get_delta_voter_ids(cursor, voter_ids):
+    # the voters of this batch that were added or changed since the base day
+    query = (
+        'SELECT registration_number '
+        'FROM delta_voter_ids '
+        'WHERE registration_number = ANY(%s) '
+        'AND change <> \'removed\''
+    )
+    cursor.execute_prepared('get_delta_voter_ids', query, (list(voter_ids),))
+    return {row['registration_number'] for row in cursor.fetchall()}
+
+
+def read_and_tally_groups(f, digest):
+    # each voter's consecutive rows, cleaned, skipping the rows that are not ingested
+    current_voter_id = None
+    current_rows = []
+    for row in csv.DictReader(f):
+        # the digest report is built from the same pass rather than a second read of the file
+        if digest:
+            tally_row(digest, row)
+        voter_id = sos_voter_id(row)
+        if voter_id is None:
+            continue
+
+        if voter_id != current_voter_id and current_rows:
+            yield current_voter_id, current_rows
+            current_rows = []
+        current_voter_id = voter_id
+        current_rows.append(clean_sos_row(row))
+    if current_rows:
+        yield current_voter_id, current_rows
 
 
-def clean_rows(rows):
-    headers = set(sos_csv_headers.keys())
-    clean_rows_ = []
-    for row in rows:
-        clean = {}
-        for k, v in row.items():
-            if not k or k.strip() not in headers:
+def load_voter_ids(cursor, voter_ids_file):
+    """
+    COPY the day's voter IDs, written one line per placed group of rows as the file was chunked, into a temp table.
+    chunk is the index of the chunk the rows went to, NULL for the voters -b leaves out of the chunks.
+    """
+    cursor.execute('CREATE TEMP TABLE sos_voter_ids (seq SERIAL, registration_number INTEGER, chunk INTEGER)')
+    voter_ids_file.seek(0)
+    cursor.copy_expert('COPY sos_voter_ids (registration_number, chunk) FROM STDIN', voter_ids_file)
+    cursor.execute('CREATE INDEX ON sos_voter_ids (registration_number)')
+    cursor.execute('ANALYZE sos_voter_ids')
+
+
+def get_split_voters(cursor):
+    """
+    Voter ID => chunk index for the voters whose rows were placed more than once, because the SoS file
+    interleaves them with other voters' rows. All of a voter's rows belong in the chunk their first rows went to.
+    """
+    query = (
+        'SELECT registration_number, (array_agg(chunk ORDER BY seq))[1] AS chunk '
+        'FROM sos_voter_ids '
+        'WHERE chunk IS NOT NULL '
+        'GROUP BY registration_number '
+        'HAVING COUNT(*) > 1'
+    )
+    cursor.execute(query)
+    return {row['registration_number']: row['chunk'] for row in cursor.fetchall()}
+
+
+def get_split_voter_rows(stem, split_voters):
+    # read the file again for only these voters, so each one's rows are in file order
+    voter_rows = {voter_id: [] for voter_id in split_voters}
+    with open_csv(f'{stem}.csv') as f:
+        for row in csv.DictReader(f):
+            voter_id = sos_voter_id(row)
+            if voter_id in voter_rows:
+                voter_rows[voter_id].append(clean_sos_row(row))
+    return voter_rows
+
+
+def regroup_chunk(path, i, split_voters, voter_rows):
+    """
+    Rewrite a chunk file so that each voter's rows are contiguous, as ingest_sos_chunk.py requires:
+    the split voters' rows are taken out and the rows of those that belong in this chunk are appended whole.
+    Streams the chunk, returns its number of voters and rows.
+    """
+    voters = 0
+    rows = 0
+    previous_voter_id = None
+    with open(path, newline='') as f, open(f'{path}.tmp', 'w', newline='') as out:
+        writer = csv.DictWriter(out, sos_csv_headers.keys())
+        writer.writeheader()
+        for row in csv.DictReader(f):
+            if int(row['VOTER_ID']) in split_voters:
                 continue
-            # strip leading and trailing whitespace from all keys and values
-            # reducing all inter-string whitespace to a single ' '
-            clean[k.strip()] = ' '.join(v.strip().split()) if type(v) is str else v
-        clean_rows_.append(clean)
-    return clean_rows_
+            if row['VOTER_ID'] != previous_voter_id:
+                voters += 1
+                previous_voter_id = row['VOTER_ID']
+            writer.writerow(row)
+            rows += 1
+        for voter_id, chunk in split_voters.items():
+            if chunk == i:
+                writer.writerows(voter_rows[voter_id])
+                voters += 1
+                rows += len(voter_rows[voter_id])
+    os.replace(f'{path}.tmp', path)
+    return voters, rows
 
 
-def main():
-    # remove the leading BOM present in many Excel documents and CSVs exported from Excel
-    replace_bom(f'csvs/sos/{args.day}.csv')
+def mark_removed(cursor):
+    """
+    Mark every voter in the DB that is not among the day's voter IDs (load_voter_ids) as removed
+    with a single anti-join UPDATE, so voters and their logs never leave Postgres.
+    """
+    query = (
+        'UPDATE voters '
+        'SET logs = array_append(logs, %s), '
+        'log = array_to_string(array_append(logs, %s), E\'\\n\'), '
+        'was_removed = true '
+        'WHERE NOT EXISTS ('
+        'SELECT 1 FROM sos_voter_ids s WHERE s.registration_number = voters.registration_number'
+        ') '
+        'RETURNING registration_number'
+    )
+    entry = ' | '.join([f'SoS-{args.day}.csv', 'REMOVE'])
+    cursor.execute(query, (entry, entry))
+    removed = cursor.fetchall()
+    for row in removed:
+        logging.info(' | '.join([f'SoS-{args.day}.csv', 'REMOVE', 'registration_number', str(row['registration_number'])]))
+
+    cursor.execute('DROP TABLE sos_voter_ids')
+    return len(removed)
 
+
+def main():
     stem = f'csvs/sos/{args.day}'
-    voters = {}
+    digest = new_digest() if args.digest else None
 
-    with codecs.open(f'{stem}.csv', encoding='utf-8', errors='ignore') as f:
-        # load the entire file into memory and create a dictionary based on voter ID
-        for row in csv.DictReader(f):
-            if row.get('VOTER_ID'):
-                # skip any row that does not provide a value for these fields
-                if not all([row.get(pk) for pk in ['FIRST_NAME', 'LAST_NAME', 'RESIDENTIAL_ADDRESS_LINE_1']]):
-                    continue
-                try:
-                    key = int(row.get('VOTER_ID'))
-                    if key in voters:
-                        voters[key] += [row]
-                    else:
-                        voters[key] = [row]
-                except ValueError:
-                    # skip any row that has a non-int for VOTER_ID
-                    continue
-
-    all_voter_ids = list(voters.keys())
-    chunk_size = len(all_voter_ids) // number_of_chunks
-    chunks = create_chunks(all_voter_ids, chunk_size + number_of_chunks)
-
-    for i, chunk in enumerate(chunks):
-        print(f'Writing {stem}_{i + 1}.csv...')
-        with open(f'{stem}_{i + 1}.csv', 'w') as f:
-            writer = csv.DictWriter(f, sos_csv_headers.keys())
+    # with -b only the voters that were added or changed since the base day are chunked
+    # a voter unchanged since the base day is left out, ingest would only skip them
+    if args.base_day:
+        summary = diff(args.base_day, args.day, ids_path=f'{stem}_diff_ids.csv')
+        print(f'{summary["added"]} added and {summary["changed"]} changed voters since {args.base_day}')
+
+    # the predicted cost, voters and rows of each chunk
+    chunk_costs = [0] * number_of_chunks
+    chunk_voters = [0] * number_of_chunks
+    chunk_rows = [0] * number_of_chunks
+
+    def place(voter_id, rows, is_chunked, is_new):
+        # every voter ID goes to disk for mark_removed as it is placed, rather than being held until the end
+        if not is_chunked:
+            voter_ids_file.write(f'{voter_id}\t\\N\n')
+            return
+        # greedy bin packing: each voter goes to the chunk with the least predicted work so far
+        # (this replaced routing by a hash of VOTER_ID, so an interleaved voter can land in two chunks, see get_split_voters)
+        i = min(range(number_of_chunks), key=chunk_costs.__getitem__)
+        voter_ids_file.write(f'{voter_id}\t{i}\n')
+        chunk_costs[i] += voter_cost(rows, is_new)
+        chunk_voters[i] += 1
+        chunk_rows[i] += len(rows)
+        writers[i].writerows(rows)
+
+    # stream the file once, holding only a batch of voters' rows until they can be costed and placed
+    print(f'Writing {stem}_1.csv ... {stem}_{number_of_chunks}.csv...')
+    voter_ids_file = tempfile.TemporaryFile(mode='w+')
+    chunk_files = [open(f'{stem}_{i + 1}.csv', 'w', newline='') for i in range(number_of_chunks)]
+    try:
+        writers = [csv.DictWriter(f, sos_csv_headers.keys()) for f in chunk_files]
+        for writer in writers:
             writer.writeheader()
-            for voter_id in chunk:
-                writer.writerows(clean_rows(voters[voter_id]))
-
-    # get all voter IDs in the DB and check them against the CSV
-    # we will rely on ingest_sos_chunk.py to set was_removed to false if a voter re-appears
-    all_voter_ids_set = set(all_voter_ids)
-    total = len(all_voter_ids_set)
-    print('Checking for any removed voters...')
-    i = 1
-    with Postgres(**postgres_args) as cursor:
-        query = 'SELECT id, registration_number, logs FROM voters'
-        cursor.execute(query)
-        for row in cursor.fetchall():
-            print(f'Checking voter {i}...', end='\r')
-            i += 1
-            if dict(row)['registration_number'] not in all_voter_ids_set:
-                mark_removed(cursor, dict(row))
+
+        with open_csv(f'{stem}.csv') as f, Postgres(**postgres_args) as cursor:
+            if args.base_day:
+                load_delta_voter_ids(cursor, f'{stem}_diff_ids.csv')
+
+            # one lookup per batch tells changed voters from unchanged ones and new voters from existing ones
+            for batch in batched(read_and_tally_groups(f, digest), lookup_batch_size):
+                voter_ids = [voter_id for voter_id, _ in batch]
+                chunked_voter_ids = get_delta_voter_ids(cursor, voter_ids) if args.base_day else set(voter_ids)
+                existing_voter_ids = get_existing_voter_ids(cursor, chunked_voter_ids)
+                for voter_id, rows in batch:
+                    place(voter_id, rows, voter_id in chunked_voter_ids, voter_id not in existing_voter_ids)
+
+            if args.base_day:
+                cursor.execute('DROP TABLE delta_voter_ids')
+    finally:
+        for f in chunk_files:
+            f.close()
+
+    with voter_ids_file, Postgres(**postgres_args) as cursor:
+        load_voter_ids(cursor, voter_ids_file)
+
+        # a voter placed more than once had their rows split up by other voters, possibly across chunks
+        split_voters = get_split_voters(cursor)
+        if split_voters:
+            print(f'Grouping the rows of {len(split_voters)} interleaved voters...')
+            voter_rows = get_split_voter_rows(stem, split_voters)
+            # a split voter's later rows can be in any chunk, so every chunk is rewritten
+            # the predicted costs are left as placed, moving a few voters barely changes them
+            for i in range(number_of_chunks):
+                chunk_voters[i], chunk_rows[i] = regroup_chunk(f'{stem}_{i + 1}.csv', i, split_voters, voter_rows)
+
+        manifest = {
+            'day': args.day,
+            'number_of_chunks': number_of_chunks,
+            'cost_weights': cost_weights,
+            'chunks': [
+                {'chunk': i + 1, 'voters': chunk_voters[i], 'rows': chunk_rows[i], 'predicted_cost': chunk_costs[i]}
+                for i in range(number_of_chunks)
+            ]
+        }
+        with open(f'{stem}_manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        print(f'Wrote {stem}_manifest.json, predicted cost per chunk: {", ".join([str(round(c)) for c in chunk_costs])}')
+
+        if digest:
+            # cached so that digest_sos.py -d / -t for this day does not parse the file again
+            report = summarize(digest)
+            save_cached_report(args.day, report)
+            print()
+            print_report(report)
+            print()
+
+        # mark every voter in the DB that is not in the CSV as removed
+        # we will rely on ingest_sos_chunk.py to set was_removed to false if a voter re-appears
+        print('Checking for any removed voters...')
+        print(f'Marked {mark_removed(cursor)} voters as removed')
 
 
 if __name__ == '__main__':
@@ -102,6 +293,10 @@ if __name__ == '__main__':
     parser.add_argument('-d', dest='day', required=True)
     parser.add_argument('-n', dest='number_of_chunks', type=int, required=True)
     parser.add_argument('-p', dest='is_prod', action='store_true', default=False)
+    # also print the digest_sos.py report, computed in the same pass over the file
+    parser.add_argument('-g', dest='digest', action='store_true', default=False)
+    # only chunk voters that were added or changed since this day's file, which must be the last day ingested
+    parser.add_argument('-b', dest='base_day')
     args = parser.parse_args()
     number_of_chunks = args.number_of_chunks
 
@@ -7,6 +7,9 @@ from services import Postgres
 from dotenv import load_dotenv
 from constants import voter_demographics_keys, consolidated_demographics_keys, survey_responses_keys, qid_question_map, rid_response_map
 
+# commit the reload every batch_size inserts rather than once per insert
+batch_size = 1000
+
 
 def transform_survey_data(path):
     voters = {}
@@ -48,7 +51,7 @@ def check_for_van_numbers():
             if row.get('Pref Phone '):
                 numbers[int(row['Voter File VANID'])] = row.get('Pref Phone ')
 
-    with Postgres(**postgres_args) as cursor:
+    with Postgres(**postgres_args, batch_size=batch_size) as cursor:
         for van_id, number in numbers.items():
             query = (
                 'UPDATE voter_demographics '
@@ -56,6 +59,7 @@ def check_for_van_numbers():
                 'WHERE van_id = %s'
             )
             cursor.execute(query, (number, van_id))
+            cursor.checkpoint(f'van_id {van_id}')
 
 
 def main():
@@ -81,7 +85,7 @@ def main():
         )
         fut.result()
 
-        with Postgres(**postgres_args) as cursor:
+        with Postgres(**postgres_args, batch_size=batch_size) as cursor:
             # delete existing rows
             cursor.execute(f'DELETE FROM {sql_table}')
 
@@ -94,6 +98,7 @@ def main():
                     columns = tuple(survey_responses_keys)
                     values = tuple([row[k] for k in survey_responses_keys])
                     cursor.execute(query, (AsIs(','.join(columns)), values))
+                    cursor.checkpoint(f'{sql_table} {voter_id}')
             else:
                 with open(path) as f:
                     for row in csv.DictReader(f):
@@ -104,6 +109,7 @@ def main():
                         columns = tuple(row.keys())
                         values = tuple([row[k] if row[k] != '' else None for k in keys])
                         cursor.execute(query, (AsIs(','.join(columns)), values))
+                        cursor.checkpoint(f'{sql_table} {row.get("registration_number")}')
 
         os.remove(path)
 
@@ -6,6 +6,10 @@ DROP TABLE IF EXISTS consolidated_demographics;
 DROP TABLE IF EXISTS survey_responses;
 DROP TABLE IF EXISTS wrong_numbers;
 DROP TABLE IF EXISTS right_numbers;
+DROP TABLE IF EXISTS unknown_voters;
+DROP TABLE IF EXISTS observed_rejections;
+-- indexes and later changes are migrations (migrate.py), initialize.py applies them all after this file
+DROP TABLE IF EXISTS schema_migrations;
 
 CREATE TABLE voters (
     -- our data:
@@ -24,6 +28,7 @@ CREATE TABLE voters (
     was_ever_rejected BOOLEAN DEFAULT false,
     currently_rejected BOOLEAN DEFAULT false,
     reject_reason TEXT,
+    sos_digest TEXT,
 
     -- their data:
     last_name  TEXT,
@@ -1,9 +1,362 @@
-from psycopg2 import connect, extras
+import atexit
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from psycopg2 import connect, extensions, extras, errors, pool, OperationalError, InterfaceError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from uuid import uuid4
 
+# settings for the process-wide connection pools, change them with configure_pool before the first Postgres()
+pool_settings = {
+    # connections opened with the pool and kept open
+    'minconn': 1,
+    # connections a process may hold at once, Postgres() waits for one to be returned beyond this
+    'maxconn': 8,
+    # a connection that has been idle this long is checked with SELECT 1 before it is handed out again
+    'check_after_seconds': 30,
+}
+
+# name => SQL of every statement run through BatchCursor.execute_prepared, filled in as they are first used
+statements = {}
+
+# False sends execute_prepared's SQL as is, e.g. behind a transaction pooling proxy (PgBouncer) that may hand
+# each transaction a different server session, where a statement PREPAREd on one may not exist on the next
+prepare_statements = True
+
+# rows fetched per round trip by stream=True cursors unless Postgres(itersize=...) says otherwise
+default_itersize = 2000
+
+# per-statement timings, None unless enable_timing has been called
+timing = None
+
+# (pid, dsn) => ConnectionPool, a forked worker never touches its parent's connections
+pools = {}
+pools_lock = threading.Lock()
+
+
+def configure_pool(minconn=None, maxconn=None, check_after_seconds=None):
+    for key, value in [('minconn', minconn), ('maxconn', maxconn), ('check_after_seconds', check_after_seconds)]:
+        if value is not None:
+            pool_settings[key] = value
+
+
+def get_pool(dsn):
+    key = (os.getpid(), dsn)
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(dsn, **pool_settings)
+        return pools[key]
+
+
+@atexit.register
+def close_pools():
+    with pools_lock:
+        for (pid, _), connection_pool in pools.items():
+            if pid == os.getpid():
+                connection_pool.closeall()
+
+
+def enable_timing(slow_seconds=1.0):
+    """
+    Time every statement run on a Postgres() cursor from now on, see StatementTiming.
+    """
+    global timing
+    timing = StatementTiming(slow_seconds)
+    return timing
+
+
+def redact(vars):
+    # parameters are voters' names, addresses and birth dates, only their types are logged
+    if vars is None:
+        return ''
+    def describe(value):
+        if value is None:
+            return 'None'
+        if isinstance(value, (list, tuple)):
+            return f'{type(value).__name__}[{len(value)}]'
+        return type(value).__name__
+    return '(' + ', '.join([describe(value) for value in vars]) + ')'
+
+
+class StatementTiming:
+    """
+    Call count, latency and rows per statement template: the SQL with its %s placeholders,
+    or the name for execute_prepared. Latencies are counted in buckets 5% wide rather than kept,
+    so the p95 costs the same memory after a million calls as after ten.
+    A statement slower than slow_seconds is logged with its parameters redacted to their types.
+    """
+
+    bucket_growth = 1.05
+    # the lower edge of bucket 0
+    bucket_floor = 1e-6
+
+    def __init__(self, slow_seconds):
+        self.slow_seconds = slow_seconds
+        self.started = time.time()
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def record(self, template, seconds, rows, vars):
+        bucket = int(math.log(max(seconds, self.bucket_floor) / self.bucket_floor, self.bucket_growth))
+        with self.lock:
+            stats = self.templates.get(template)
+            if stats is None:
+                stats = self.templates[template] = {'calls': 0, 'seconds': 0, 'max_seconds': 0, 'rows': 0, 'buckets': {}}
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += max(rows, 0)
+            stats['buckets'][bucket] = stats['buckets'].get(bucket, 0) + 1
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            logging.warning(' | '.join(['SLOW', f'{round(seconds * 1000)} ms', ' '.join(template.split()), redact(vars)]))
+
+    def percentile(self, stats, p):
+        # the upper edge of the bucket holding the p-th call, never more than the slowest call
+        count = 0
+        for bucket in sorted(stats['buckets']):
+            count += stats['buckets'][bucket]
+            if count >= p * stats['calls']:
+                return min(self.bucket_floor * self.bucket_growth ** (bucket + 1), stats['max_seconds'])
+        return stats['max_seconds']
+
+    def report(self):
+        with self.lock:
+            templates = list(self.templates.items())
+        report = [
+            {
+                'template': template,
+                'calls': stats['calls'],
+                'total_seconds': stats['seconds'],
+                'mean_ms': stats['seconds'] / stats['calls'] * 1000,
+                'p95_ms': self.percentile(stats, 0.95) * 1000,
+                'max_ms': stats['max_seconds'] * 1000,
+                'rows': stats['rows'],
+            }
+            for template, stats in templates
+        ]
+        return sorted(report, key=lambda r: r['total_seconds'], reverse=True)
+
+    def write(self, path, print_summary=True):
+        """
+        Write the full report to path as JSON and print a summary table, slowest total first.
+        """
+        report = self.report()
+        wall_seconds = time.time() - self.started
+        if print_summary:
+            print(f'{"statement":<60} {"calls":>9} {"total s":>9} {"mean ms":>9} {"p95 ms":>9} {"rows":>10}')
+            for r in report:
+                template = ' '.join(r['template'].split())
+                template = template if len(template) <= 60 else template[:57] + '...'
+                print(f'{template:<60} {r["calls"]:>9} {r["total_seconds"]:>9.2f} {r["mean_ms"]:>9.2f} {r["p95_ms"]:>9.2f} {r["rows"]:>10}')
+            print(f'{round(sum([r["total_seconds"] for r in report]), 2)}s of {round(wall_seconds, 2)}s in Postgres')
+        with open(path, 'w') as f:
+            json.dump({
+                'started': self.started,
+                'wall_seconds': wall_seconds,
+                'slow_seconds': self.slow_seconds,
+                'statements': report,
+            }, f, indent=2)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of connections to one database.
+
+    Unlike psycopg2's ThreadedConnectionPool, getconn waits for a connection when all maxconn are in use
+    instead of raising, and a connection that has sat idle is health checked (and replaced if it is dead)
+    before it is handed out. Connections go back to the pool outside of any transaction.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, check_after_seconds):
+        self.pool = pool.ThreadedConnectionPool(minconn, maxconn, dsn, connection_factory=Connection)
+        self.available = threading.BoundedSemaphore(maxconn)
+        self.check_after_seconds = check_after_seconds
+        # id(connection) => when it was last returned
+        self.last_used = {}
+
+    def getconn(self):
+        self.available.acquire()
+        try:
+            while True:
+                connection = self.pool.getconn()
+                if self.healthy(connection):
+                    return connection
+                logging.info('POOL | replacing a dead connection')
+                self.last_used.pop(id(connection), None)
+                self.pool.putconn(connection, close=True)
+        except Exception:
+            self.available.release()
+            raise
+
+    def healthy(self, connection):
+        if connection.closed:
+            return False
+        last_used = self.last_used.get(id(connection))
+        if last_used is None or time.time() - last_used < self.check_after_seconds:
+            return True
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def putconn(self, connection, close=False):
+        """
+        close discards the connection rather than reusing it, e.g. after an error that may have left
+        session state (temp tables, an aborted transaction) behind.
+        """
+        try:
+            if not close and not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except (OperationalError, InterfaceError):
+                    close = True
+            close = close or bool(connection.closed)
+            if close:
+                self.last_used.pop(id(connection), None)
+            else:
+                self.last_used[id(connection)] = time.time()
+            self.pool.putconn(connection, close=close)
+        finally:
+            self.available.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+class Connection(extensions.connection):
+    """
+    Connection that remembers which registered statements have been PREPAREd on its session.
+    Pooled connections keep their prepared statements from one Postgres() to the next.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class BatchCursor(extras.DictCursor):
+    """
+    DictCursor that knows when its connection is due for a commit.
+
+    Callers mark safe points with checkpoint(marker), e.g. after a voter has been fully written.
+    batch_size counts writes (INSERT, UPDATE, DELETE, COPY), the SELECTs in between are not counted.
+    Outside of batched mode the connection autocommits and checkpoint only records the marker.
+    on_commit, if set, is called with the marker every time work up to that marker is committed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = None
+        self.batch_seconds = None
+        self.pending = 0
+        self.last_commit_time = time.time()
+        self.marker = None
+        self.last_committed = None
+        self.on_commit = None
+
+    def execute(self, query, vars=None, template=None):
+        if timing is None:
+            result = super().execute(query, vars)
+        else:
+            start = time.perf_counter()
+            try:
+                result = super().execute(query, vars)
+            finally:
+                timing.record(template or query, time.perf_counter() - start, self.rowcount, vars)
+        self.count_write()
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        if timing is None:
+            result = super().copy_expert(sql, file, size)
+        else:
+            start = time.perf_counter()
+            try:
+                result = super().copy_expert(sql, file, size)
+            finally:
+                timing.record(sql, time.perf_counter() - start, self.rowcount, None)
+        # psycopg2 leaves no command tag after a COPY, a COPY ... FROM is a write
+        if 'FROM STDIN' in sql.upper():
+            self.pending += 1
+        return result
+
+    def count_write(self):
+        # the command tag, also for EXECUTE of a prepared statement, says what the statement did
+        if (self.statusmessage or '').startswith(('INSERT', 'UPDATE', 'DELETE')):
+            self.pending += 1
+
+    def execute_prepared(self, name, query, vars=None):
+        """
+        Run query (with %s placeholders, as for execute) as the named statement name.
+        It is PREPAREd the first time this connection runs it and EXECUTEd from then on,
+        so Postgres parses and plans it once per connection rather than on every call.
+        A name always stands for the same SQL, name dynamic statements after what varies (e.g. their columns).
+        """
+        if statements.setdefault(name, query) != query:
+            raise ValueError(f'{name} is already registered for a different statement')
+        prepared = getattr(self.connection, 'prepared', None)
+        if not prepare_statements or prepared is None:
+            return self.execute(query, vars, template=name)
+
+        if name not in prepared:
+            self.prepare(name, query)
+        number_of_params = query.count('%s')
+        execute = f'EXECUTE {name} ({", ".join(["%s"] * number_of_params)})' if number_of_params else f'EXECUTE {name}'
+        try:
+            return self.execute(execute, vars, template=name)
+        except errors.InvalidSqlStatementName:
+            # the session lost the statement (e.g. DISCARD ALL), outside of a transaction it can be prepared again
+            prepared.discard(name)
+            if not self.connection.autocommit:
+                raise
+            self.prepare(name, query)
+            return self.execute(execute, vars, template=name)
+
+    def prepare(self, name, query):
+        # PREPARE uses $1, $2, ... where execute uses %s
+        params = iter(range(1, query.count('%s') + 1))
+        super().execute(f'PREPARE {name} AS ' + re.sub('%s', lambda _: f'${next(params)}', query))
+        self.connection.prepared.add(name)
+
+    def checkpoint(self, marker=None):
+        self.marker = marker
+        if self.connection.autocommit:
+            self.committed()
+            return
+        if self.batch_size and self.pending >= self.batch_size:
+            self.commit()
+        elif self.batch_seconds and time.time() - self.last_commit_time >= self.batch_seconds:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        if self.pending:
+            logging.info(' | '.join(['COMMIT', f'{self.pending} writes', f'last committed: {self.marker}']))
+        self.pending = 0
+        self.last_commit_time = time.time()
+        self.committed()
+
+    def committed(self):
+        self.last_committed = self.marker
+        if self.on_commit and self.marker is not None:
+            self.on_commit(self.marker)
+
 
 class Postgres:
-    def __init__(self, user, password, dbname, host, port, stream=False):
+    """
+    Context manager that hands out a cursor on a connection from the process-wide pool for these credentials,
+    the connection is returned to the pool on exit. pooled=False opens and closes a dedicated connection instead.
+    """
+
+    def __init__(self, user, password, dbname, host, port, stream=False, batch_size=None, batch_seconds=None,
+                 pooled=True, itersize=None):
         self.user = user
         self.password = password
         self.dbname = dbname
@@ -13,20 +366,63 @@ class Postgres:
         self.name = None
         if stream:
             self.name = uuid4().hex
-        pass
+        # commit every batch_size writes or batch_seconds seconds (whichever comes first) at checkpoints
+        # instead of autocommitting every statement
+        self.batched = not stream and bool(batch_size or batch_seconds)
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.itersize = itersize or default_itersize
+        self.last_committed = None
+        self.pooled = pooled
+        self.dsn = f'dbname={self.dbname} user={self.user} password={self.password} host={self.host} port={self.port}'
 
     def __enter__(self):
-        self.connection = connect(
-            f'dbname={self.dbname} user={self.user} password={self.password} host={self.host} port={self.port}')
-        self.connection.autocommit = not self.stream
-        self.cursor = self.connection.cursor(cursor_factory=extras.DictCursor, name=self.name)
+        self.connection = get_pool(self.dsn).getconn() if self.pooled else connect(self.dsn, connection_factory=Connection)
+        self.connection.autocommit = not self.stream and not self.batched
+        if self.stream:
+            self.cursor = self.connection.cursor(cursor_factory=extras.DictCursor, name=self.name)
+            self.cursor.itersize = self.itersize
+        else:
+            self.cursor = self.connection.cursor(cursor_factory=BatchCursor)
+            self.cursor.batch_size = self.batch_size
+            self.cursor.batch_seconds = self.batch_seconds
         return self.cursor
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self.cursor.close()
-        if self.stream:
-            if exception_value:
-                self.connection.rollback()
+        # a connection that saw an error is closed rather than reused, it may be broken or hold session state
+        # (a stream_rows generator that was closed early is not an error)
+        failed = exception_value is not None and not isinstance(exception_value, GeneratorExit)
+        try:
+            if self.batched:
+                if exception_value:
+                    self.connection.rollback()
+                    # everything after this marker was rolled back and is safe to re-run
+                    logging.error(' | '.join(['ROLLBACK', f'last committed: {self.cursor.last_committed}']))
+                    print(f'Rolled back, last committed: {self.cursor.last_committed}')
+                else:
+                    self.cursor.commit()
+                self.last_committed = self.cursor.last_committed
+            self.cursor.close()
+            if self.stream:
+                if exception_value:
+                    self.connection.rollback()
+                else:
+                    self.connection.commit()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if self.pooled:
+                get_pool(self.dsn).putconn(self.connection, close=failed)
             else:
-                self.connection.commit()
-        self.connection.close()
+                self.connection.close()
+
+
+def stream_rows(postgres_args, query, vars=None, itersize=None):
+    """
+    Run a query on a server-side cursor and yield its rows, fetched itersize at a time, so client memory stays
+    flat however many rows match. Rows are DictRows (a list sharing one column index), use dict(row) to keep one.
+    """
+    with Postgres(**postgres_args, stream=True, itersize=itersize) as cursor:
+        cursor.execute(query, vars)
+        yield from cursor
@@ -0,0 +1,344 @@
+import csv
+import argparse
+import array
+import datetime
+import json
+import os
+import pathlib
+import numpy as np
+from constants import sos_csv_headers
+from common import open_csv, sos_voter_id, clean_sos_row
+
+"""
+Archives each day's SoS CSV as a typed columnar snapshot in csvs/sos/archive/<day>/ and answers questions
+across days without scanning the raw text files.
+
+- VOTER_ID is an int64 array, rows are sorted by it (keeping each voter's row order) for binary search
+- dates are int32 ordinals (0 when empty), decoded in the format the source file used (9/1/2020 or 09/01/2020)
+- low-cardinality columns (party, county, status, methods, void, ...) are dictionary encoded:
+  the smallest unsigned int array that fits, plus <column>.json of values
+- every other column (names, addresses, phone numbers, ...) is text: the UTF-8 values back to back in
+  <column>.bytes.npy and where each row's value starts in <column>.offsets.npy
+
+Columns are plain .npy files so they load memory-mapped, only the pages a query touches are read:
+a lookup decodes its own rows' slices of the text columns rather than loading a dictionary of every name.
+(zlib compressed .npz files cannot be memory-mapped.)
+
+    python3 sos_archive.py -a 10-31           # archive a day (-a all archives every new or changed day)
+    python3 sos_archive.py -v 123456          # a voter's rows on every archived day
+    python3 sos_archive.py -v 123456 -k BALLOT_STATUS  # the days a voter's BALLOT_STATUS changed
+"""
+
+archive_dir = 'csvs/sos/archive'
+headers = list(sos_csv_headers.keys())
+date_columns = {'REQUEST_DATE', 'SENT_DATE', 'RECEIVED_DATE', 'DATE_OF_BIRTH'}
+# how the SoS writes dates, unpadded first as in the files compare_and_log compares against
+date_formats = ['%-m/%-d/%Y', '%m/%d/%Y']
+# columns with a small, fixed set of values, their dictionaries stay small however many rows a day has
+dictionary_columns = {
+    'COUNTY_CODE', 'ELECTION_DATE', 'STATE_HOUSE_NAME', 'STATE_SENATE_NAME', 'CONGRESSIONAL', 'POLITICAL_PARTY',
+    'IS_VOID', 'STATUS', 'NAME_SUFFIX', 'CT_ST_STATE', 'IS_STANDARD', 'ABSENTEE_ISSUE_METHOD', 'RECEIVE_METHOD',
+    'MAIL_STATE', 'FPCA', 'BALLOT_STATUS',
+}
+
+# loaded snapshots by day, their arrays are memory-mapped so keeping them around is cheap
+snapshots = {}
+
+
+def source_key(day):
+    stat = os.stat(f'csvs/sos/{day}.csv')
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def to_ordinal(value):
+    # accepts zero padded and unpadded dates alike
+    return datetime.datetime.strptime(value, '%m/%d/%Y').date().toordinal() if value else 0
+
+
+def from_ordinal(ordinal, date_format='%m/%d/%Y'):
+    return datetime.date.fromordinal(int(ordinal)).strftime(date_format) if ordinal else ''
+
+
+def source_date_format(values):
+    """
+    The format every one of a date column's values is written in, so ordinals decode to exactly the source
+    string, e.g. 9/1/2020 as compare_and_log writes it. None if the column mixes formats or has a malformed date.
+    """
+    for date_format in date_formats:
+        try:
+            if all([from_ordinal(to_ordinal(value), date_format) == value for value in values]):
+                return date_format
+        except ValueError:
+            return None
+    return None
+
+
+def is_archived(day):
+    try:
+        with open(f'{archive_dir}/{day}/meta.json') as f:
+            meta = json.load(f)
+        # snapshots from before date_formats was recorded may decode dates differently from the source, rebuild them
+        return meta['source'] == source_key(day) and 'date_formats' in meta
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def gather(blob, starts, lengths, block_size=65536):
+    # the byte ranges starts[i]:starts[i] + lengths[i] of blob back to back, a block of rows at a time
+    for i in range(0, len(starts), block_size):
+        block_starts = starts[i:i + block_size]
+        block_lengths = lengths[i:i + block_size]
+        ends = np.cumsum(block_lengths)
+        if len(ends) and ends[-1]:
+            yield blob[np.repeat(block_starts - (ends - block_lengths), block_lengths) + np.arange(ends[-1])]
+
+
+def archive(day):
+    """
+    Encode a day's SoS file (cleaned and filtered as process_sos_csv.py does) into a snapshot.
+    """
+    voter_ids = array.array('q')
+    # dictionary and date columns: codes, and value => code where insertion order is code order
+    codes = {header: array.array('I') for header in headers if header in dictionary_columns | date_columns}
+    dictionaries = {header: {} for header in codes}
+    # text columns: the UTF-8 values in file order and their lengths
+    blobs = {header: bytearray() for header in headers if header not in codes and header != 'VOTER_ID'}
+    lengths = {header: array.array('q') for header in blobs}
+
+    with open_csv(f'csvs/sos/{day}.csv') as f:
+        for row in csv.DictReader(f):
+            voter_id = sos_voter_id(row)
+            if voter_id is None:
+                continue
+            clean = clean_sos_row(row)
+            voter_ids.append(voter_id)
+            for header in codes:
+                value = clean.get(header) or ''
+                dictionary = dictionaries[header]
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                codes[header].append(code)
+            for header in blobs:
+                value = (clean.get(header) or '').encode('utf-8')
+                blobs[header] += value
+                lengths[header].append(len(value))
+
+    directory = pathlib.Path(f'{archive_dir}/{day}')
+    directory.mkdir(parents=True, exist_ok=True)
+
+    voter_ids = np.frombuffer(voter_ids, dtype=np.int64)
+    order = np.argsort(voter_ids, kind='stable')
+    np.save(directory / 'VOTER_ID.npy', voter_ids[order])
+
+    encodings = {'VOTER_ID': 'int'}
+    date_formats_used = {}
+    for header in headers:
+        if header in blobs:
+            column_lengths = np.frombuffer(lengths[header], dtype=np.int64)
+            starts = np.concatenate([[0], np.cumsum(column_lengths)[:-1]]).astype(np.int64)
+            sorted_lengths = column_lengths[order]
+            blob = np.frombuffer(blobs[header], dtype=np.uint8)
+            # rewritten in VOTER_ID order, so a voter's values are one contiguous slice
+            np.save(directory / f'{header}.offsets.npy', np.concatenate([[0], np.cumsum(sorted_lengths)]).astype(np.int64))
+            np.save(directory / f'{header}.bytes.npy', np.concatenate(
+                list(gather(blob, starts[order], sorted_lengths)) or [np.zeros(0, dtype=np.uint8)]))
+            encodings[header] = 'text'
+            continue
+        if header not in codes:
+            continue
+
+        column = np.frombuffer(codes[header], dtype=np.uint32)[order]
+        values = list(dictionaries[header].keys())
+
+        # only the distinct values are parsed, then every row is mapped at once
+        date_format = source_date_format(values) if header in date_columns else None
+        if date_format:
+            ordinals = np.array([to_ordinal(value) for value in values], dtype=np.int32)
+            np.save(directory / f'{header}.npy', ordinals[column] if len(values) else column.astype(np.int32))
+            encodings[header] = 'date'
+            date_formats_used[header] = date_format
+            continue
+        # a malformed date or mixed formats keep the column dictionary encoded, so it still reads back as written
+
+        dtype = np.uint8 if len(values) <= 2 ** 8 else np.uint16 if len(values) <= 2 ** 16 else np.uint32
+        np.save(directory / f'{header}.npy', column.astype(dtype))
+        with open(directory / f'{header}.json', 'w') as f:
+            json.dump(values, f, separators=(',', ':'))
+        encodings[header] = 'dictionary'
+
+    with open(directory / 'meta.json', 'w') as f:
+        meta = {
+            'day': day,
+            'source': source_key(day),
+            'rows': len(voter_ids),
+            'encodings': encodings,
+            'date_formats': date_formats_used,
+        }
+        json.dump(meta, f, indent=2)
+    snapshots.pop(day, None)
+    return len(voter_ids)
+
+
+def archived_days():
+    return sorted([path.parent.name for path in pathlib.Path(archive_dir).glob('*/meta.json')])
+
+
+def load_snapshot(day):
+    if day not in snapshots:
+        directory = f'{archive_dir}/{day}'
+        try:
+            with open(f'{directory}/meta.json') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise FileNotFoundError(f'SoS {day} is not archived, run python3 sos_archive.py -a {day} first') from None
+        columns = {}
+        for header, encoding in meta['encodings'].items():
+            if encoding == 'text':
+                columns[header] = (
+                    np.load(f'{directory}/{header}.offsets.npy', mmap_mode='r'),
+                    np.load(f'{directory}/{header}.bytes.npy', mmap_mode='r'),
+                )
+            else:
+                columns[header] = np.load(f'{directory}/{header}.npy', mmap_mode='r')
+        snapshots[day] = {
+            'meta': meta,
+            'columns': columns,
+            # dictionaries are only read when a query needs them
+            'dictionaries': {},
+        }
+    return snapshots[day]
+
+
+def dictionary(snapshot, header):
+    if header not in snapshot['dictionaries']:
+        with open(f'{archive_dir}/{snapshot["meta"]["day"]}/{header}.json') as f:
+            snapshot['dictionaries'][header] = json.load(f)
+    return snapshot['dictionaries'][header]
+
+
+def decode(snapshot, header, i):
+    # row i's value of header as it appears in the CSV
+    encoding = snapshot['meta']['encodings'][header]
+    column = snapshot['columns'][header]
+    if encoding == 'int':
+        return str(column[i])
+    if encoding == 'date':
+        # snapshots from before date_formats was recorded were written zero padded
+        return from_ordinal(column[i], snapshot['meta'].get('date_formats', {}).get(header, '%m/%d/%Y'))
+    if encoding == 'text':
+        offsets, blob = column
+        return bytes(blob[offsets[i]:offsets[i + 1]]).decode('utf-8')
+    return dictionary(snapshot, header)[column[i]]
+
+
+def rows_at(snapshot, indices, columns=None):
+    # rows as dicts of header => string, of only columns if given
+    columns = columns or snapshot['meta']['encodings'].keys()
+    return [{header: decode(snapshot, header, i) for header in columns} for i in indices]
+
+
+def lookup(day, voter_id, columns=None):
+    """
+    A voter's rows on day, [] if they are not in that day's file.
+    columns limits the rows to those headers, so no other column is read.
+    """
+    snapshot = load_snapshot(day)
+    voter_ids = snapshot['columns']['VOTER_ID']
+    start = np.searchsorted(voter_ids, voter_id, side='left')
+    end = np.searchsorted(voter_ids, voter_id, side='right')
+    return rows_at(snapshot, range(start, end), columns)
+
+
+def find_text(column, value):
+    # rows of a text column equal to value, only the rows of the same length are compared
+    offsets, blob = column
+    value = value.encode('utf-8')
+    candidates = np.flatnonzero(np.diff(offsets) == len(value))
+    return np.array([i for i in candidates if bytes(blob[offsets[i]:offsets[i + 1]]) == value], dtype=np.int64)
+
+
+def find(day, header, value, columns=None):
+    """
+    Every row on day where header equals value (e.g. find('10-31', 'BALLOT_STATUS', 'Defective Affidavit/Envelope')).
+    """
+    snapshot = load_snapshot(day)
+    encoding = snapshot['meta']['encodings'][header]
+    if encoding == 'int':
+        return lookup(day, int(value), columns)
+    column = snapshot['columns'][header]
+    if encoding == 'date':
+        return rows_at(snapshot, np.flatnonzero(column == to_ordinal(value)), columns)
+    if encoding == 'text':
+        return rows_at(snapshot, find_text(column, value), columns)
+    try:
+        code = dictionary(snapshot, header).index(value)
+    except ValueError:
+        return []
+    return rows_at(snapshot, np.flatnonzero(column == code), columns)
+
+
+def between(day, header, start, end, columns=None):
+    """
+    Every row on day where start <= header <= end, for VOTER_ID and the date columns (dates as MM/DD/YYYY).
+    """
+    snapshot = load_snapshot(day)
+    encoding = snapshot['meta']['encodings'][header]
+    column = snapshot['columns'][header]
+    if encoding == 'int':
+        return rows_at(snapshot, range(
+            np.searchsorted(column, int(start), side='left'), np.searchsorted(column, int(end), side='right')), columns)
+    if encoding == 'date':
+        return rows_at(snapshot, np.flatnonzero((column >= to_ordinal(start)) & (column <= to_ordinal(end))), columns)
+    raise ValueError(f'{header} is not a range column')
+
+
+def history(voter_id, days=None, columns=None):
+    return {day: lookup(day, voter_id, columns) for day in days or archived_days()}
+
+
+def changes(voter_id, header, days=None):
+    """
+    The days on which a voter's values for header (one per row) differ from the previous archived day,
+    as (day, previous values, values). A voter missing from a day has None.
+    """
+    result = []
+    previous = None
+    for i, (day, rows) in enumerate(history(voter_id, days, [header]).items()):
+        values = [row[header] for row in rows] if rows else None
+        if i > 0 and values != previous:
+            result.append((day, previous, values))
+        previous = values
+    return result
+
+
+def main():
+    if args.archive:
+        days = args.archive.split(',')
+        if args.archive == 'all':
+            days = sorted([path.stem for path in pathlib.Path('csvs/sos').glob('??-??.csv')])
+        for day in days:
+            if is_archived(day):
+                continue
+            print(f'Archiving {day}.csv...')
+            print(f'{archive(day)} rows')
+
+    if args.voter_id:
+        if args.column:
+            for day, previous, values in changes(args.voter_id, args.column):
+                print(f'{day}: {previous} => {values}')
+        else:
+            for day, rows in history(args.voter_id).items():
+                print(day)
+                for row in rows:
+                    print('   ', {k: v for k, v in row.items() if v})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # a day, comma separated days, or all
+    parser.add_argument('-a', dest='archive')
+    parser.add_argument('-v', dest='voter_id', type=int)
+    parser.add_argument('-k', dest='column', choices=headers)
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,74 @@
+import datetime
+import unittest
+from constants import sos_csv_headers, date_keys
+from sos_engine import apply_rows
+
+"""
+Regression tests for the SoS ingest rules, run with: python3 -m unittest test_sos_engine
+"""
+
+
+def sos_row(**values):
+    # a cleaned SoS row (as process_sos_csv.py writes them) for a voter in Adair, a county that reports ballot status, every other column empty
+    row = {header: '' for header in sos_csv_headers.keys()}
+    row.update({
+        'COUNTY_CODE': '01',
+        'VOTER_ID': '123456',
+        'FIRST_NAME': 'JANE',
+        'LAST_NAME': 'DOE',
+        'RESIDENTIAL_ADDRESS_LINE_1': '100 MAIN ST',
+        'POLITICAL_PARTY': 'Democrat',
+        'IS_VOID': '0',
+        'REQUEST_DATE': '9/20/2020',
+    })
+    row.update(values)
+    return row
+
+
+def store(state):
+    # the voter as get_voters would return it after the plan was applied: dates as dates, timestamps set
+    voter = {**state, 'created_at': None, 'updated_at': None}
+    for key in date_keys:
+        if isinstance(voter.get(key), str):
+            voter[key] = datetime.datetime.strptime(voter[key], '%m/%d/%Y').date()
+    return voter
+
+
+def ingest_days(days):
+    # apply each day's rows to the voter as the previous day stored them
+    voter = None
+    for day, rows in days:
+        state, _ = apply_rows(voter, rows, day)
+        voter = store(state)
+    return voter
+
+
+class TestRejectAndCure(unittest.TestCase):
+
+    def test_unchanged_rows_still_cure(self):
+        # day N records the rejection of the voided ballot, the same rows on day N + 1 cure the voter
+        requested = [sos_row()]
+        rejected_and_resent = [
+            sos_row(IS_VOID='1', BALLOT_STATUS='Defective Affidavit/Envelope', RECEIVED_DATE='10/1/2020'),
+            sos_row(RECEIVED_DATE='10/5/2020'),
+        ]
+        voter = ingest_days([('10-04', requested), ('10-05', rejected_and_resent)])
+        self.assertTrue(voter['was_ever_rejected'])
+        self.assertIsNone(voter['cure_date'])
+
+        voter = ingest_days([('10-04', requested), ('10-05', rejected_and_resent), ('10-06', rejected_and_resent)])
+        self.assertEqual(voter['cure_date'], '2020-10-06')
+        self.assertFalse(voter['currently_rejected'])
+
+    def test_unchanged_rows_cure_after_county_rejection(self):
+        # a rejection recorded by ingest_county.py between SoS days is cured by unchanged SoS rows
+        rows = [sos_row(RECEIVED_DATE='10/5/2020')]
+        voter = ingest_days([('10-05', rows)])
+        voter = {**voter, 'was_ever_rejected': True, 'currently_rejected': True}
+
+        state, _ = apply_rows(voter, rows, '10-06')
+        self.assertEqual(state['cure_date'], '2020-10-06')
+
+
+if __name__ == '__main__':
+    unittest.main()